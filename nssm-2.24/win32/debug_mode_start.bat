@@ -2,6 +2,8 @@
 :: Rik Wachner - 1720651 - PingMyHealth Project 2020 - IIT
 @ECHO off
 ECHO PingMyHome Proof of Concept DEBUG MODE [1.0]
+:: Shared PingMyHealth modules and machine learning environment modules for all python services (see README.md)
+SET PYTHONPATH=C:\PingMyHealth\service_oriented_architecture_python_modules;C:\PingMyHealth\service_oriented_architecture_python_modules\MachineLearningEnvironment
 ECHO Call PingMyHome Proof of Concept Service Stopper...
 cd C:\PingMyHealth\nssm-2.24\win32
 CALL service_stop.bat
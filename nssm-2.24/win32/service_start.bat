@@ -4,6 +4,10 @@
 cd C:\PingMyHealth\nssm-2.24\win32
 ECHO PingMyHome Proof of Concept Service Starter [1.0]
 ECHO.
+:: Shared PingMyHealth modules for all python services (see README.md)
+SET PYTHONPATH=C:\PingMyHealth\service_oriented_architecture_python_modules;C:\PingMyHealth\service_oriented_architecture_python_modules\MachineLearningEnvironment
+FOR %%S IN (modbusserverslavesimulation modbusclientmaster openweathermapdatacollector pingmyhealthchecker flaskwebrequestconnector) DO nssm set %%S AppEnvironmentExtra PYTHONPATH=%PYTHONPATH%
+ECHO.
 ECHO Start InfluxDB Service...
 nssm start influxdb
 timeout 2
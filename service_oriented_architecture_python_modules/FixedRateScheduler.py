@@ -0,0 +1,169 @@
+# !DOCUMENTATION SPHINX STYLE
+
+# -*- PingMyHealth -*-
+# Rik Wachner - 1720651 - PingMyHealth Project 2020 - IIT
+
+"""
+PingMyHealth fixed rate scheduler
+----------------------------------------------------------------------------
+
+Drift-free fixed rate loop for all PingMyHealth services, which waits for
+monotonic deadlines instead of sleeping the sampling rate after the work
+
+"""
+import asyncio
+import time
+
+# ----------------------------------------------------------------------- #
+# LOGGING                                                                 #
+# ----------------------------------------------------------------------- #
+import logging
+
+log = logging.getLogger()
+
+# ----------------------------------------------------------------------- #
+# PARAMS                                                                  #
+# ----------------------------------------------------------------------- #
+SKIP = "skip" # Missed ticks are skipped, the loop continues on the next tick of the grid
+CATCH_UP = "catch_up" # Missed ticks run back to back until the loop is on time again
+statistics_report_interval = 60 # Ticks between two statistics reports in the log
+
+
+class LoopStatistics(object):
+    """ Jitter, overrun and busy time statistics of a loop
+    """
+
+    def __init__(self, name, report_interval=statistics_report_interval):
+        """
+        :param string name: name of the loop in the log
+        :param int report_interval: ticks between two statistics reports in the log, 0 = no report
+        """
+        self.name = name
+        self.report_interval = report_interval
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped_ticks = 0
+        self.jitter_sum = 0.0
+        self.jitter_max = 0.0
+        self.busy_time = 0.0
+        self.elapsed_time = 0.0
+
+    def record(self, jitter, busy_time, elapsed_time):
+        """ Record one tick of the loop
+
+        :param float jitter: seconds the tick started after its deadline
+        :param float busy_time: seconds of work in the last tick
+        :param float elapsed_time: seconds between the last and this tick
+        """
+        self.ticks += 1
+        self.jitter_sum += abs(jitter)
+        self.jitter_max = max(self.jitter_max, abs(jitter))
+        self.busy_time += busy_time
+        self.elapsed_time += elapsed_time
+        if self.report_interval and self.ticks % self.report_interval == 0:
+            log.info('LOOP %s STATISTICS: %s' % (self.name, self.statistics()))
+
+    def overrun(self, skipped_ticks):
+        """ Record an overrun of the loop
+
+        :param int skipped_ticks: count of ticks, which were skipped because of the overrun
+        """
+        self.overruns += 1
+        self.skipped_ticks += skipped_ticks
+
+    def statistics(self):
+        """ Get the statistics of the loop
+
+        :return: dictionary of the statistics
+        """
+        return {
+            'ticks': self.ticks,
+            'overruns': self.overruns,
+            'skippedTicks': self.skipped_ticks,
+            'jitterMean': self.jitter_sum / self.ticks if self.ticks else 0.0,
+            'jitterMax': self.jitter_max,
+            'busyRatio': self.busy_time / self.elapsed_time if self.elapsed_time else 0.0
+        }
+
+
+class FixedRateScheduler(object):
+    """ Run a loop on a fixed grid of monotonic deadlines
+
+    Call wait() where the loop used to sleep the sampling rate. The work time of the loop is taken from the
+    period, so the period stays fixed and does not drift
+    """
+
+    def __init__(self, name, period, policy=SKIP, max_catch_up=10, report_interval=statistics_report_interval,
+                 clock=time.monotonic, sleep=time.sleep):
+        """
+        :param string name: name of the loop in the log
+        :param float period: seconds between two ticks
+        :param string policy: SKIP or CATCH_UP missed ticks
+        :param int max_catch_up: maximum missed ticks to catch up, all further missed ticks are skipped
+        :param int report_interval: ticks between two statistics reports in the log, 0 = no report
+        :param function clock: monotonic clock in seconds
+        :param function sleep: sleep function in seconds
+        """
+        if period <= 0:
+            raise ValueError('%s IS NOT A VALID LOOP PERIOD' % period)
+        if policy not in (SKIP, CATCH_UP):
+            raise ValueError('%s IS NOT A VALID LOOP POLICY' % policy)
+        self.period = period
+        self.policy = policy
+        self.max_catch_up = max_catch_up
+        self.clock = clock
+        self.sleep = sleep
+        self.statistics = LoopStatistics(name, report_interval)
+        self.deadline = clock()
+        self.tick_start = self.deadline
+        self.busy_time = 0.0
+        self.backlog = 0 # Late ticks, which the loop catches up after the last overrun
+
+    def wait(self):
+        """ Wait for the next deadline of the loop
+        """
+        delay = self.next_delay()
+        if delay > 0:
+            self.sleep(delay)
+        self.start_tick()
+
+    async def wait_async(self):
+        """ Wait for the next deadline of the loop without blocking the asyncio event loop
+        """
+        delay = self.next_delay()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self.start_tick()
+
+    def next_delay(self):
+        """ Finish the current tick and schedule the next deadline by the policy
+
+        An overrun is counted once: the catch-up ticks of its backlog start after their deadlines, but they are only
+        a new overrun, if the loop fell further behind
+
+        :return: seconds until the next deadline
+        """
+        now = self.clock()
+        self.busy_time = now - self.tick_start
+        self.deadline += self.period
+        missed_ticks = int((now - self.deadline) // self.period) + 1 if now > self.deadline else 0
+        if missed_ticks:
+            if self.policy == SKIP:
+                skipped_ticks = missed_ticks
+            else:
+                skipped_ticks = max(0, missed_ticks - self.max_catch_up)
+            # The last tick consumed one late tick of the backlog, more missed ticks are a new overrun
+            if missed_ticks >= self.backlog:
+                log.warning('LOOP %s OVERRUN BY %.3f SECONDS, %s TICKS SKIPPED' % (
+                    self.statistics.name, now - self.deadline, skipped_ticks))
+                self.statistics.overrun(skipped_ticks)
+            self.deadline += skipped_ticks * self.period
+        self.backlog = missed_ticks - skipped_ticks if missed_ticks else 0
+        return self.deadline - self.clock()
+
+    def start_tick(self):
+        """ Start the next tick and record its statistics
+        """
+        last_tick_start = self.tick_start
+        self.tick_start = self.clock()
+        self.statistics.record(self.tick_start - self.deadline, self.busy_time, self.tick_start - last_tick_start)
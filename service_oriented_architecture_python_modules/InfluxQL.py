@@ -0,0 +1,31 @@
+# !DOCUMENTATION SPHINX STYLE
+
+# -*- PingMyHealth -*-
+# Rik Wachner - 1720651 - PingMyHealth Project 2020 - IIT
+
+"""
+PingMyHealth InfluxQL helpers
+----------------------------------------------------------------------------
+
+Quoting of the identifiers and string literals of the InfluxQL queries of
+all PingMyHealth services
+
+"""
+
+
+def quote_identifier(identifier):
+    """ Quote a measurement, field or tag name for an InfluxQL query
+
+    :param string identifier: measurement, field or tag name
+    :return: quoted identifier
+    """
+    return '"%s"' % str(identifier).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def quote_string(string):
+    """ Quote a string literal, e.g. a tag value, for an InfluxQL query
+
+    :param string string: string literal
+    :return: quoted string literal
+    """
+    return "'%s'" % str(string).replace('\\', '\\\\').replace("'", "\\'")
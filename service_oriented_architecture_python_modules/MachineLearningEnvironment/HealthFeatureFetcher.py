@@ -0,0 +1,138 @@
+# !DOCUMENTATION SPHINX STYLE
+
+# -*- PingMyHealth -*-
+# Rik Wachner - 1720651 - PingMyHealth Project 2020 - IIT
+
+"""
+PingMyHealth health feature fetcher
+----------------------------------------------------------------------------
+
+Fetch all model features of all patients of the machine learning
+environment with one query and build a feature matrix (one row per patient)
+in the fixed order of the training columns. Missing and stale features are
+reported instead of predicted
+
+"""
+from InfluxQL import quote_identifier, quote_string
+import numpy as np
+import time
+
+# ----------------------------------------------------------------------- #
+# LOGGING                                                                 #
+# ----------------------------------------------------------------------- #
+import logging
+
+log = logging.getLogger()
+
+
+class HealthFeatureFetcher(object):
+    """ Fetch the latest value of every model feature of every patient
+
+    The patients are the tag sets of the patient tag (e.g. the device of the asynchronous modbus client), values
+    without the patient tag belong to the patient ''
+    """
+
+    def __init__(self, features, field='valueScaled', max_age=None, patient_tag=None):
+        """
+        :param list features: features [(measurement, description), ...] in the order of the training columns
+        :param string field: field of the feature values
+        :param float max_age: seconds after which a feature value is stale, None = never stale
+        :param string patient_tag: tag of the patients, None = one patient
+        """
+        self.features = list(features)
+        self.field = field
+        self.max_age = max_age
+        self.patient_tag = patient_tag
+        self.positions = {feature: position for position, feature in enumerate(self.features)}
+        self.measurements = ','.join(quote_identifier(measurement) for measurement in sorted(
+            {measurement for measurement, description in self.features}))
+        self.where = ' OR '.join('"description" = %s' % quote_string(description) for description in sorted(
+            {description for measurement, description in self.features}))
+        self.group_by = quote_identifier('description')
+        if patient_tag is not None:
+            self.group_by += ',' + quote_identifier(patient_tag)
+        # The database filters the descriptions and selects the latest value of every feature of every patient
+        self.query = 'SELECT LAST(%s) AS %s FROM %s WHERE %s GROUP BY %s' % (
+            quote_identifier(field), quote_identifier(field), self.measurements, self.where, self.group_by)
+
+    def feature_names(self, positions):
+        """ Get the names of features
+
+        :param positions: positions of the features in the feature vector or boolean mask of the features
+        :return: list of the feature names "measurement/description"
+        """
+        if isinstance(positions, np.ndarray) and positions.dtype == bool:
+            positions = np.flatnonzero(positions).tolist()
+        return ['%s/%s' % self.features[position] for position in positions]
+
+    def window_query(self, start, end, interval):
+        """ Build the query of the values of a time window, aligned to a time grid
+
+        :param int start: start of the window in nanoseconds (included), a multiple of the interval
+        :param int end: end of the window in nanoseconds (excluded)
+        :param int interval: seconds of the time grid
+        :return: query of the latest value of every feature of every patient in every interval
+        """
+        return 'SELECT LAST(%s) AS %s FROM %s WHERE (%s) AND time >= %d AND time < %d GROUP BY time(%ds),%s ' \
+               'fill(none)' % (quote_identifier(self.field), quote_identifier(self.field), self.measurements,
+                               self.where, start, end, interval, self.group_by)
+
+    def fetch_window(self, influxdb_client, database, start, end, interval):
+        """ Fetch the feature values of all patients of a time window, aligned to a time grid
+
+        :param InfluxDBClient influxdb_client: client of the database server
+        :param string database: database of the features
+        :param int start: start of the window in nanoseconds (included), a multiple of the interval
+        :param int end: end of the window in nanoseconds (excluded)
+        :param int interval: seconds of the time grid
+        :return: patients, start times of the intervals, feature values (patients x intervals x features, intervals
+                 without a value of the feature are nan)
+        """
+        times = np.arange(start, end, interval * 1000000000, dtype=np.int64)
+        rows = {}
+        result = influxdb_client.query(self.window_query(start, end, interval), database=database, epoch='ns')
+        for (measurement, tags), points in result.items():
+            position = self.positions.get((measurement, tags['description']))
+            if position is None:
+                continue # The description belongs to another measurement
+            patient = tags.get(self.patient_tag, '') if self.patient_tag is not None else ''
+            if patient not in rows:
+                rows[patient] = np.full((len(times), len(self.features)), np.nan)
+            for point in points:
+                if point[self.field] is not None:
+                    rows[patient][(point['time'] - start) // (interval * 1000000000), position] = point[self.field]
+        patients = sorted(rows)
+        values = np.array([rows[patient] for patient in patients]).reshape(len(patients), len(times),
+                                                                            len(self.features))
+        return patients, times, values
+
+    def fetch(self, influxdb_client, database, now=None):
+        """ Fetch the feature matrix of all patients
+
+        :param InfluxDBClient influxdb_client: client of the database server
+        :param string database: database of the features
+        :param int now: current time in nanoseconds, default is the clock
+        :return: patients, feature matrix (one row per patient, missing features are nan), boolean matrices of the
+                 missing and stale features
+        """
+        now = time.time_ns() if now is None else now
+        rows = {}
+        for (measurement, tags), points in influxdb_client.query(self.query, database=database, epoch='ns').items():
+            position = self.positions.get((measurement, tags['description']))
+            if position is None:
+                continue # The description belongs to another measurement
+            patient = tags.get(self.patient_tag, '') if self.patient_tag is not None else ''
+            if patient not in rows:
+                rows[patient] = (np.full(len(self.features), np.nan), np.zeros(len(self.features), dtype=np.int64))
+            for point in points:
+                if point[self.field] is not None:
+                    rows[patient][0][position] = point[self.field]
+                    rows[patient][1][position] = point['time']
+        patients = sorted(rows)
+        matrix = np.array([rows[patient][0] for patient in patients]).reshape(len(patients), len(self.features))
+        times = np.array([rows[patient][1] for patient in patients]).reshape(len(patients), len(self.features))
+        missing = np.isnan(matrix)
+        stale = np.zeros(matrix.shape, dtype=bool)
+        if self.max_age is not None:
+            stale = ~missing & (now - times > self.max_age * 1000000000)
+        return patients, matrix, missing, stale
@@ -0,0 +1,232 @@
+# !DOCUMENTATION SPHINX STYLE
+
+# -*- PingMyHealth -*-
+# Rik Wachner - 1720651 - PingMyHealth Project 2020 - IIT
+
+"""
+PingMyHealth model registry
+----------------------------------------------------------------------------
+
+Versioned store of the trained models. Every version is one artifact with
+the fitted scaler, the classifier, the order of the feature columns and
+the test score. The file LATEST names the version the services use
+
+The artifacts are stored uncompressed, so the services load them memory
+mapped in milliseconds instead of training the model at every start
+
+"""
+from datetime import datetime, timezone
+import numpy as np
+import joblib
+import os
+
+# ----------------------------------------------------------------------- #
+# LOGGING                                                                 #
+# ----------------------------------------------------------------------- #
+import logging
+
+log = logging.getLogger()
+
+# ----------------------------------------------------------------------- #
+# PARAMS                                                                  #
+# ----------------------------------------------------------------------- #
+artifact_file_name = "model.joblib" # Artifact of a version
+latest_file_name = "LATEST" # Version the services use
+positive_class = 1 # Class of the hearth disease, the services store its probability
+
+
+def new_version():
+    """ Get the version of a new model, the training time, so the versions sort by their age
+
+    :return: version, e.g. 20200613120000
+    """
+    return datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')
+
+
+class ModelArtifact(object):
+    """ Trained model of one version: scaler, classifier, feature columns and score
+    """
+
+    def __init__(self, version, scaler, classifier, feature_columns, score, classifier_name=None, created=None):
+        """
+        :param string version: version of the model
+        :param StandardScaler scaler: scaler fitted on the training data
+        :param classifier: fitted sklearn classifier
+        :param list feature_columns: feature columns in the order of the training data
+        :param float score: score of the classifier on the test data
+        :param string classifier_name: name of the classifier, default is its class
+        :param string created: creation time (ISO 8601), default is now
+        """
+        self.version = version
+        self.scaler = scaler
+        self.classifier = classifier
+        self.feature_columns = list(feature_columns)
+        self.score = score
+        self.classifier_name = classifier_name or type(classifier).__name__
+        self.created = created or datetime.now(timezone.utc).isoformat()
+
+    @property
+    def classes_(self):
+        """ Classes of the classifier
+        """
+        return self.classifier.classes_
+
+    @property
+    def positive_column(self):
+        """ Column of the positive class in the class probabilities
+        """
+        return list(self.classes_).index(positive_class)
+
+    def predict_proba(self, features):
+        """ Scale the features like the training data and predict the class probabilities
+
+        :param features: feature matrix (one row per sample) in the order of the feature columns
+        :return: class probabilities (one row per sample)
+        """
+        return self.classifier.predict_proba(self.scaler.transform(features))
+
+    def predict(self, features):
+        """ Scale the features like the training data and predict the classes
+
+        :param features: feature matrix (one row per sample) in the order of the feature columns
+        :return: classes (one per sample)
+        """
+        return self.classifier.predict(self.scaler.transform(features))
+
+    def append(self, features, labels):
+        """ Append labelled samples to the classifier without refit, e.g. the neighbour index of a
+        NeighbourIndexClassifier. The scaler stays as fitted on the training data
+
+        :param features: feature matrix (one row per sample) in the order of the feature columns
+        :param labels: class of every sample
+        """
+        if not hasattr(self.classifier, 'append'):
+            raise ValueError('%s IS NOT A VALID CLASSIFIER TO APPEND TO' % self.classifier_name)
+        self.classifier.append(self.scaler.transform(features), labels)
+
+
+class ModelRegistry(object):
+    """ Directory of the model versions {path}/{version}/model.joblib and the pointer {path}/LATEST
+    """
+
+    def __init__(self, path, feature_columns=None, mmap_mode='r'):
+        """
+        :param string path: directory of the registry
+        :param list feature_columns: feature columns of the service, only models of these columns are loaded
+        :param string mmap_mode: memory map mode of the loaded arrays, None = load into memory
+        """
+        self.path = path
+        self.feature_columns = None if feature_columns is None else list(feature_columns)
+        self.mmap_mode = mmap_mode
+        self.latest_stat = None
+
+    def versions(self):
+        """ Get all stored versions
+
+        :return: sorted list of the versions
+        """
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(version for version in os.listdir(self.path)
+                      if os.path.isfile(os.path.join(self.path, version, artifact_file_name)))
+
+    def latest_version(self):
+        """ Get the version the services use
+
+        :return: version or None, if the registry is empty
+        """
+        try:
+            with open(os.path.join(self.path, latest_file_name)) as latest_file:
+                return latest_file.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def save(self, artifact, compress=0, latest=True):
+        """ Store an artifact as a new version
+
+        :param ModelArtifact artifact: trained model
+        :param int compress: joblib compression level, 0 = uncompressed (memory mapped loading)
+        :param bool latest: the services should use the new version
+        :return: path of the artifact
+        """
+        directory = os.path.join(self.path, artifact.version)
+        if os.path.exists(os.path.join(directory, artifact_file_name)):
+            raise ValueError('%s IS ALREADY A STORED MODEL VERSION' % artifact.version)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, artifact_file_name)
+        # Write and rename, so a service never loads a half written artifact
+        joblib.dump(artifact.__dict__, path + '.tmp', compress=compress)
+        os.replace(path + '.tmp', path)
+        if latest:
+            self.set_latest(artifact.version)
+        return path
+
+    def set_latest(self, version):
+        """ Let the services use a stored version, e.g. to roll back
+
+        :param string version: stored version
+        """
+        if version not in self.versions():
+            raise ValueError('%s IS NOT A STORED MODEL VERSION' % version)
+        path = os.path.join(self.path, latest_file_name)
+        with open(path + '.tmp', 'w') as latest_file:
+            latest_file.write(version)
+        os.replace(path + '.tmp', path)
+
+    def load(self, version=None):
+        """ Load an artifact
+
+        :param string version: version, None = the latest version
+        :return: ModelArtifact
+        """
+        self.latest_stat = self.stat_latest()
+        version = version or self.latest_version()
+        if version is None:
+            raise ValueError('%s IS NOT A VALID MODEL REGISTRY' % self.path)
+        log.info('LOAD MODEL VERSION %s...' % version)
+        artifact = ModelArtifact(**joblib.load(os.path.join(self.path, version, artifact_file_name),
+                                               mmap_mode=self.mmap_mode))
+        if self.feature_columns is not None and artifact.feature_columns != self.feature_columns:
+            raise ValueError('FEATURE COLUMNS %s OF MODEL VERSION %s ARE NOT THE FEATURE COLUMNS %s' % (
+                artifact.feature_columns, version, self.feature_columns))
+        # The services store the probability of the positive class, a model without it is rejected here and not
+        # in every prediction
+        classes = np.asarray(artifact.classes_).tolist()
+        if positive_class not in classes:
+            raise ValueError('CLASSES %s OF MODEL VERSION %s DO NOT CONTAIN THE CLASS %s' % (
+                classes, version, positive_class))
+        log.info('LOAD MODEL VERSION %s SUCCESSFULLY' % version)
+        return artifact
+
+    def stat_latest(self):
+        """ Get the modification of the pointer to the latest version
+
+        :return: (modification time, size) or None, if there is no pointer
+        """
+        try:
+            stat = os.stat(os.path.join(self.path, latest_file_name))
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def reload(self, artifact):
+        """ Load the latest version, if the pointer changed since the last load
+
+        A version, which fails to load, is logged and the current artifact stays in use
+
+        :param ModelArtifact artifact: artifact in use
+        :return: the new artifact or the artifact in use
+        """
+        latest_stat = self.stat_latest()
+        if latest_stat == self.latest_stat:
+            return artifact
+        self.latest_stat = latest_stat
+        version = self.latest_version()
+        if version is None or artifact is not None and version == artifact.version:
+            return artifact
+        try:
+            return self.load(version)
+        except Exception as e:
+            log.error('LOAD MODEL VERSION %s FAILED, KEEP VERSION %s: %s' % (
+                version, None if artifact is None else artifact.version, e))
+            return artifact
@@ -0,0 +1,296 @@
+# !DOCUMENTATION SPHINX STYLE
+
+# -*- PingMyHealth -*-
+# Rik Wachner - 1720651 - PingMyHealth Project 2020 - IIT
+
+"""
+PingMyHealth neighbour index
+----------------------------------------------------------------------------
+
+K nearest neighbours classifier on an explicit spatial index, so the
+prediction does not search all training samples when the training data
+grows into millions of rows
+
+The index is a KD tree, a ball tree or an approximate inverted file (IVF):
+the samples are clustered and only the samples of the nearest clusters are
+searched. New labelled samples are appended to a small delta buffer, which
+is searched brute force, and merged into the index when it is full, so an
+append needs no refit of the model
+
+The index is part of the model artifact, the model registry persists it
+
+"""
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.metrics import pairwise_distances
+from sklearn.neighbors import BallTree, KDTree
+import numpy as np
+
+# ----------------------------------------------------------------------- #
+# LOGGING                                                                 #
+# ----------------------------------------------------------------------- #
+import logging
+
+log = logging.getLogger()
+
+# ----------------------------------------------------------------------- #
+# PARAMS                                                                  #
+# ----------------------------------------------------------------------- #
+BRUTE = "brute" # Exact, searches all samples
+KD_TREE = "kd_tree" # Exact, fast for few features (the health data has 5)
+BALL_TREE = "ball_tree" # Exact, for more features or other metrics
+IVF = "ivf" # Approximate, searches only the samples of the n_probe nearest clusters
+index_trees = {KD_TREE: KDTree, BALL_TREE: BallTree}
+weight_functions = ["uniform", "distance"] # Weights of the neighbours in the vote
+query_chunk_size = 1000 # Query samples per search, bounds the memory of large batches
+index_chunk_size = 10000 # Indexed samples per brute force distance matrix
+
+
+def nearest(distances, indices, k):
+    """ Select the k nearest neighbours of every row
+
+    :param distances: distance matrix (one row per sample)
+    :param indices: neighbour indices of the distances
+    :param int k: count of the neighbours
+    :return: distances and indices of the k nearest neighbours sorted by distance
+    """
+    if distances.shape[1] > k:
+        selection = np.argpartition(distances, k - 1, axis=1)[:, :k]
+        distances = np.take_along_axis(distances, selection, axis=1)
+        indices = np.take_along_axis(indices, selection, axis=1)
+    order = np.argsort(distances, axis=1, kind='stable')
+    return np.take_along_axis(distances, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+
+def vote(distances, labels, classes, weights="uniform"):
+    """ Get the class probabilities of the votes of the neighbours
+
+    :param distances: distances of the neighbours (one row per sample, sorted)
+    :param labels: class positions of the neighbours (missing neighbours are -1)
+    :param int classes: count of the classes
+    :param string weights: "uniform" = every neighbour has the same vote, "distance" = closer neighbours count more
+    :return: class probabilities (one row per sample)
+    """
+    if weights == "distance":
+        with np.errstate(divide='ignore'):
+            neighbour_weights = 1 / distances
+        # Samples equal to a training sample get only the class of the equal training samples
+        exact = (distances == 0).any(axis=1)
+        neighbour_weights[exact] = distances[exact] == 0
+    else:
+        neighbour_weights = np.ones(distances.shape)
+    neighbour_weights[labels < 0] = 0
+    probabilities = np.stack([(neighbour_weights * (labels == position)).sum(axis=1) for position in range(classes)],
+                             axis=1)
+    totals = probabilities.sum(axis=1, keepdims=True)
+    totals[totals == 0] = 1
+    return probabilities / totals
+
+
+class NeighbourIndexClassifier(object):
+    """ K nearest neighbours classifier with the interface of the sklearn KNeighborsClassifier (fit, predict,
+    predict_proba, score, classes_) and appends without refit
+    """
+
+    def __init__(self, n_neighbors=4, weights="uniform", metric="euclidean", algorithm=KD_TREE, leaf_size=40,
+                 n_lists=None, n_probe=8, max_delta_size=10000):
+        """
+        :param int n_neighbors: count of the neighbours in the vote
+        :param string weights: "uniform" = every neighbour has the same vote, "distance" = closer neighbours count more
+        :param string metric: distance metric, e.g. "euclidean", "manhattan" or "chebyshev"
+        :param string algorithm: index of the samples, "brute", "kd_tree", "ball_tree" or "ivf" (approximate)
+        :param int leaf_size: samples per leaf of the trees
+        :param int n_lists: clusters of the IVF index, None = square root of the samples
+        :param int n_probe: nearest clusters searched by the IVF index, more = more exact and slower
+        :param int max_delta_size: appended samples, which are searched brute force until they are merged into
+                                   the index
+        """
+        if algorithm not in (BRUTE, KD_TREE, BALL_TREE, IVF):
+            raise ValueError('%s IS NOT A VALID NEIGHBOUR INDEX ALGORITHM' % algorithm)
+        if weights not in weight_functions:
+            raise ValueError('%s IS NOT A VALID NEIGHBOUR WEIGHT FUNCTION' % weights)
+        if algorithm in index_trees and metric not in index_trees[algorithm].valid_metrics:
+            raise ValueError('%s IS NOT A VALID METRIC OF THE %s' % (metric, algorithm))
+        self.n_neighbors = n_neighbors
+        self.weights = weights
+        self.metric = metric
+        self.algorithm = algorithm
+        self.leaf_size = leaf_size
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.max_delta_size = max_delta_size
+        self.classes_ = None
+        self.samples = None # Indexed samples
+        self.labels = None # Class positions of the indexed samples
+        self.tree = None # KD tree or ball tree of the indexed samples
+        self.centroids = None # Cluster centers of the IVF index
+        self.assignments = None # Cluster of every indexed sample
+        self.list_offsets = None # Start of every cluster in the list indices (CSR layout, memory mappable)
+        self.list_indices = None # Indexed samples sorted by cluster
+        self.delta_samples = [] # Appended samples, not yet in the index
+        self.delta_labels = []
+
+    def __len__(self):
+        return (0 if self.samples is None else len(self.samples)) + len(self.delta_samples)
+
+    def fit(self, samples, labels):
+        """ Build the index of the training data
+
+        :param samples: training samples (one row per sample), already scaled
+        :param labels: class of every sample
+        :return: self
+        """
+        self.classes_, labels = np.unique(labels, return_inverse=True)
+        self.samples = np.ascontiguousarray(samples, dtype=np.float64)
+        self.labels = labels.astype(np.intp)
+        self.delta_samples, self.delta_labels = [], []
+        if self.algorithm == IVF:
+            n_lists = self.n_lists or max(1, int(np.sqrt(len(self.samples))))
+            log.info('CLUSTER %s SAMPLES INTO %s LISTS...' % (len(self.samples), n_lists))
+            kmeans = MiniBatchKMeans(n_clusters=min(n_lists, len(self.samples)), batch_size=4096, n_init=3)
+            self.centroids = kmeans.fit(self.samples).cluster_centers_
+            log.info('CLUSTER %s SAMPLES INTO %s LISTS SUCCESSFULLY' % (len(self.samples), n_lists))
+            self.assignments = self.assign(self.samples)
+        self.build()
+        return self
+
+    def assign(self, samples):
+        """ Get the nearest cluster of samples
+
+        :param samples: samples (one row per sample)
+        :return: cluster of every sample
+        """
+        assignments = [np.empty(0, dtype=np.intp)]
+        for start in range(0, len(samples), query_chunk_size):
+            distances = pairwise_distances(samples[start:start + query_chunk_size], self.centroids)
+            assignments.append(distances.argmin(axis=1))
+        return np.concatenate(assignments)
+
+    def build(self):
+        """ Build the index of the indexed samples
+        """
+        log.info('BUILD %s INDEX OF %s SAMPLES...' % (self.algorithm.upper(), len(self.samples)))
+        if self.algorithm in index_trees:
+            self.tree = index_trees[self.algorithm](self.samples, leaf_size=self.leaf_size, metric=self.metric)
+        elif self.algorithm == IVF:
+            self.list_indices = np.argsort(self.assignments, kind='stable')
+            self.list_offsets = np.concatenate(([0], np.cumsum(np.bincount(self.assignments,
+                                                                          minlength=len(self.centroids)))))
+        log.info('BUILD %s INDEX OF %s SAMPLES SUCCESSFULLY' % (self.algorithm.upper(), len(self.samples)))
+
+    def append(self, samples, labels):
+        """ Append labelled samples without refit, they are searched at once and merged into the index, when the
+        delta buffer is full
+
+        :param samples: new samples (one row per sample), scaled like the training data
+        :param labels: class of every sample, only classes of the training data
+        """
+        samples = np.asarray(samples, dtype=np.float64).reshape(-1, self.samples.shape[1])
+        labels = np.asarray(labels)
+        positions = np.searchsorted(self.classes_, labels)
+        unknown = (positions >= len(self.classes_)) | (self.classes_[np.minimum(positions, len(self.classes_) - 1)]
+                                                        != labels)
+        if unknown.any():
+            raise ValueError('%s IS NOT A VALID CLASS OF THE MODEL' % labels[unknown][0])
+        self.delta_samples.extend(samples)
+        self.delta_labels.extend(positions.tolist())
+        if len(self.delta_samples) >= self.max_delta_size:
+            self.merge()
+
+    def merge(self):
+        """ Merge the delta buffer into the index
+        """
+        if not self.delta_samples:
+            return
+        delta_samples = np.array(self.delta_samples, dtype=np.float64)
+        self.samples = np.concatenate((self.samples, delta_samples))
+        self.labels = np.concatenate((self.labels, np.array(self.delta_labels, dtype=np.intp)))
+        if self.algorithm == IVF:
+            # The clusters stay, the new samples join their nearest cluster
+            self.assignments = np.concatenate((self.assignments, self.assign(delta_samples)))
+        self.delta_samples, self.delta_labels = [], []
+        self.build()
+
+    def search_index(self, samples, k):
+        """ Search the k nearest indexed samples
+
+        :param samples: query samples (one row per sample)
+        :param int k: count of the neighbours
+        :return: distances and indices of the neighbours (missing neighbours of the IVF index are inf and -1)
+        """
+        k = min(k, len(self.samples))
+        if self.algorithm in index_trees:
+            return self.tree.query(samples, k=k)
+        if self.algorithm == BRUTE:
+            distances = np.full((len(samples), 0), np.inf)
+            indices = np.empty((len(samples), 0), dtype=np.intp)
+            for start in range(0, len(self.samples), index_chunk_size):
+                chunk_distances = pairwise_distances(samples, self.samples[start:start + index_chunk_size],
+                                                     metric=self.metric)
+                chunk_indices = np.broadcast_to(np.arange(start, start + chunk_distances.shape[1]),
+                                                chunk_distances.shape)
+                distances, indices = nearest(np.concatenate((distances, chunk_distances), axis=1),
+                                             np.concatenate((indices, chunk_indices), axis=1), k)
+            return distances, indices
+        probes = nearest(pairwise_distances(samples, self.centroids),
+                         np.broadcast_to(np.arange(len(self.centroids)), (len(samples), len(self.centroids))),
+                         min(self.n_probe, len(self.centroids)))[1]
+        distances = np.full((len(samples), k), np.inf)
+        indices = np.full((len(samples), k), -1, dtype=np.intp)
+        for row, probe in enumerate(probes):
+            candidates = np.concatenate([self.list_indices[self.list_offsets[cluster]:self.list_offsets[cluster + 1]]
+                                         for cluster in probe])
+            if not len(candidates):
+                continue
+            candidate_distances = pairwise_distances(samples[row:row + 1], self.samples[candidates],
+                                                     metric=self.metric)
+            found = min(k, len(candidates))
+            distances[row, :found], indices[row, :found] = nearest(candidate_distances, candidates[np.newaxis], found)
+        return distances, indices
+
+    def kneighbors(self, samples, n_neighbors=None):
+        """ Search the nearest neighbours in the index and in the delta buffer
+
+        :param samples: query samples (one row per sample), scaled like the training data
+        :param int n_neighbors: count of the neighbours, None = n_neighbors of the classifier
+        :return: distances and labels of the neighbours (missing neighbours have the distance inf and the label -1)
+        """
+        n_neighbors = n_neighbors or self.n_neighbors
+        distances, indices = self.search_index(samples, n_neighbors)
+        labels = np.where(indices >= 0, self.labels[np.maximum(indices, 0)], -1)
+        if self.delta_samples:
+            delta_distances = pairwise_distances(samples, np.array(self.delta_samples), metric=self.metric)
+            delta_labels = np.broadcast_to(np.array(self.delta_labels, dtype=np.intp), delta_distances.shape)
+            distances, labels = nearest(np.concatenate((distances, delta_distances), axis=1),
+                                        np.concatenate((labels, delta_labels), axis=1),
+                                        min(n_neighbors, len(self)))
+        return distances, labels
+
+    def predict_proba(self, samples):
+        """ Predict the class probabilities
+
+        :param samples: samples (one row per sample), scaled like the training data
+        :return: class probabilities (one row per sample, columns in the order of classes_)
+        """
+        samples = np.asarray(samples, dtype=np.float64)
+        probabilities = np.zeros((len(samples), len(self.classes_)))
+        for start in range(0, len(samples), query_chunk_size):
+            distances, labels = self.kneighbors(samples[start:start + query_chunk_size])
+            probabilities[start:start + query_chunk_size] = vote(distances, labels, len(self.classes_), self.weights)
+        return probabilities
+
+    def predict(self, samples):
+        """ Predict the classes
+
+        :param samples: samples (one row per sample), scaled like the training data
+        :return: classes (one per sample)
+        """
+        return self.classes_[self.predict_proba(samples).argmax(axis=1)]
+
+    def score(self, samples, labels):
+        """ Get the accuracy
+
+        :param samples: test samples (one row per sample), scaled like the training data
+        :param labels: class of every test sample
+        :return: share of the correct predictions
+        """
+        return float(np.mean(self.predict(samples) == np.asarray(labels)))
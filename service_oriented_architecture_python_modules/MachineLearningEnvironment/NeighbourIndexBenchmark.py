@@ -0,0 +1,106 @@
+# !DOCUMENTATION SPHINX STYLE
+
+# -*- PingMyHealth -*-
+# Rik Wachner - 1720651 - PingMyHealth Project 2020 - IIT
+
+"""
+PingMyHealth neighbour index benchmark
+----------------------------------------------------------------------------
+
+Measure the build time and the predict latency of every neighbour index
+against the size of the training data. The training data is resampled
+from the hearth disease dataset with noise, so it grows like the collected
+health data of the pipeline. The approximate index reports its agreement
+with the exact prediction
+
+"""
+from sklearn.preprocessing import StandardScaler
+import pandas as pd
+import numpy as np
+import time
+
+from NeighbourIndex import NeighbourIndexClassifier
+
+# ----------------------------------------------------------------------- #
+# LOGGING                                                                 #
+# ----------------------------------------------------------------------- #
+import logging
+
+logging.basicConfig()
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+# ----------------------------------------------------------------------- #
+# PARAMS                                                                  #
+# ----------------------------------------------------------------------- #
+training_data_path = "heart.csv"
+feature_columns = ["age", "sex", "trestbps", "chol", "thalach"]
+training_sizes = [1000, 10000, 100000, 1000000] # Sizes of the training data
+algorithms = ["brute", "kd_tree", "ball_tree", "ivf"] # Neighbour indices, the first must be exact
+batch_size = 100 # Patients of one prediction cycle
+repeats = 5 # Predictions per measurement, the median is reported
+noise = 0.05 # Noise of the resampled training data (standard deviations of the scaled features)
+seed = 1720651
+
+
+def resample(samples, labels, size, rng):
+    """ Resample a training data set of any size
+
+    :param samples: scaled samples of the dataset
+    :param labels: labels of the dataset
+    :param int size: size of the training data
+    :param Generator rng: random generator
+    :return: samples, labels
+    """
+    rows = rng.integers(0, len(samples), size)
+    return samples[rows] + rng.normal(scale=noise, size=(size, samples.shape[1])), labels[rows]
+
+
+def measure(function, *args):
+    """ Measure the median run time of a function
+
+    :param function function: measured function
+    :return: median run time in seconds, result of the last run
+    """
+    times = []
+    for repeat in range(repeats):
+        start = time.perf_counter()
+        result = function(*args)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times)), result
+
+
+def run_benchmark():
+    """ Run the benchmark and log the results
+
+    :return: list of the results [(training size, algorithm, build seconds, batch seconds, single seconds,
+             agreement with the exact prediction), ...]
+    """
+    rng = np.random.default_rng(seed)
+    df = pd.read_csv(training_data_path)
+    samples = StandardScaler().fit_transform(df[feature_columns].values)
+    labels = df["target"].values
+    results = []
+    for training_size in training_sizes:
+        training_samples, training_labels = resample(samples, labels, training_size, rng)
+        queries, _ = resample(samples, labels, batch_size, rng)
+        exact = None
+        for algorithm in algorithms:
+            model = NeighbourIndexClassifier(n_neighbors=4, algorithm=algorithm)
+            start = time.perf_counter()
+            model.fit(training_samples, training_labels)
+            build_seconds = time.perf_counter() - start
+            batch_seconds, predictions = measure(model.predict, queries)
+            single_seconds, _ = measure(model.predict, queries[:1])
+            if exact is None:
+                exact = predictions
+            agreement = float(np.mean(predictions == exact))
+            results.append((training_size, algorithm, build_seconds, batch_seconds, single_seconds, agreement))
+            log.info('SIZE %9s %-10s BUILD %8.3f S   BATCH OF %s %8.2f MS   SINGLE %8.2f MS   AGREEMENT %.3f' % (
+                training_size, algorithm, build_seconds, batch_size, batch_seconds * 1000, single_seconds * 1000,
+                agreement))
+    return results
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,249 @@
+# !DOCUMENTATION SPHINX STYLE
+
+# -*- PingMyHealth -*-
+# Rik Wachner - 1720651 - PingMyHealth Project 2020 - IIT
+
+"""
+PingMyHealth prediction backfill
+----------------------------------------------------------------------------
+
+Recompute the predictions of a past time range with a model version, e.g.
+after a new model version was trained. The health data is read in time
+windows (chunks) on the grid of the sampling rate, so the memory does not
+grow with the time range. Every feature keeps its latest value until a
+newer one arrives or it is stale, like the live prediction
+
+All predictions of a chunk are predicted in one batch and written with the
+modelVersion tag of the model at the end of their interval, when the live
+prediction had seen the values. After every chunk a checkpoint is written,
+a stopped backfill resumes from the checkpoint
+
+"""
+from datetime import datetime, timezone
+from influxdb import InfluxDBClient
+import numpy as np
+import json
+import time
+import os
+
+from HealthFeatureFetcher import HealthFeatureFetcher
+from ModelRegistry import ModelRegistry
+
+# ----------------------------------------------------------------------- #
+# LOGGING                                                                 #
+# ----------------------------------------------------------------------- #
+import logging
+
+logging.basicConfig()
+log = logging.getLogger()
+log.setLevel(logging.DEBUG)
+
+# ----------------------------------------------------------------------- #
+# PARAMS                                                                  #
+# ----------------------------------------------------------------------- #
+version = "1.0.0"
+influxdb_server_host, influxdb_server_port = "localhost", 8086
+write_database_name = "ml_environment_db"
+read_database_name = "modbus_i_o_db"
+model_registry_path = "model_registry" # Versions of the trained models
+model_version = None # Version of the backfilled predictions, None = the LATEST version
+model_features = ["age", "sex", "trestbps", "chol", "thalach"] # Training columns of the health data values
+measurement_name = "hearth_disease_prediction"
+# ALL needed prediction values (from the database) in the order of the training columns
+# age, sex, trestbps (resting blood pressure), chol (cholesterin), thalach (maximum heart rate)
+health_data = [
+    ("fitnessband_input_register", "Age"),
+    ("fitnessband_input_register", "Sex"),
+    ("fitnessband_input_register", "Systolic blood pressure value"),
+    ("cholesterin_fastchecker_input_register", "Cholesterin"),
+    ("fitnessband_input_register", "Pulse")
+]
+health_data_field = 'valueScaled'
+health_data_max_age = 2 * 3600 # Seconds after which a value is stale, e.g. the age is polled every hour
+patient_tag = "device" # Tag of the patients, every patient gets an own prediction, None = one patient
+backfill_start = "2020-06-01T00:00:00+00:00" # Start of the backfilled time range (ISO 8601)
+backfill_end = None # End of the backfilled time range (ISO 8601), None = the start of the first run
+backfill_interval = 30 # Seconds of the prediction grid, the sampling rate of the machine learning environment
+chunk_duration = 6 * 3600 # Seconds of the time window of one query, bounds the memory
+write_batch_size = 5000 # Points per write request
+checkpoint_path = "backfill_checkpoint_{model_version}.json" # Progress of the backfill of a model version
+
+
+def database_connection():
+    """ Connect to the database
+    """
+    client = InfluxDBClient(influxdb_server_host, influxdb_server_port)
+    client.create_database(write_database_name)
+    return client
+
+
+def parse_time(timestamp):
+    """ Get the nanoseconds of a timestamp
+
+    :param string timestamp: timestamp (ISO 8601)
+    :return: nanoseconds since the epoch
+    """
+    moment = datetime.fromisoformat(timestamp)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp()) * 1000000000 + moment.microsecond * 1000
+
+
+def load_checkpoint(path, version, start, end):
+    """ Load the checkpoint of a backfill
+
+    :param string path: path of the checkpoint
+    :param string version: model version of the backfill
+    :param int start: start of the time range in nanoseconds
+    :param int end: end of the time range in nanoseconds, None = the end of the checkpoint
+    :return: next chunk start in nanoseconds, end of the time range in nanoseconds, carried values {patient: (values,
+             sample times)} or None, if there is no checkpoint of this backfill
+    """
+    try:
+        with open(path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+    except FileNotFoundError:
+        return None
+    if checkpoint['modelVersion'] != version or checkpoint['start'] != start or end not in (None, checkpoint['end']):
+        raise ValueError('%s IS NOT A VALID CHECKPOINT OF THIS BACKFILL' % path)
+    carry = {patient: (np.array(values, dtype=np.float64), np.array(times, dtype=np.int64))
+             for patient, (values, times) in checkpoint['carry'].items()}
+    return checkpoint['next'], checkpoint['end'], carry
+
+
+def save_checkpoint(path, version, start, end, next_start, carry):
+    """ Save the checkpoint of a backfill (write and rename, so a stopped backfill never leaves half a checkpoint)
+
+    :param string path: path of the checkpoint
+    :param string version: model version of the backfill
+    :param int start: start of the time range in nanoseconds
+    :param int end: end of the time range in nanoseconds
+    :param int next_start: start of the next chunk in nanoseconds
+    :param dict carry: carried values {patient: (values, sample times)}
+    """
+    checkpoint = {
+        'modelVersion': version,
+        'start': start,
+        'end': end,
+        'next': next_start,
+        'carry': {patient: ([None if np.isnan(value) else value for value in values.tolist()], times.tolist())
+                  for patient, (values, times) in carry.items()}
+    }
+    with open(path + '.tmp', 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(path + '.tmp', path)
+
+
+def carry_forward(patients, times, values, carry, interval):
+    """ Align the features per interval: every feature keeps its latest value until a newer value arrives, starting
+    with the carried values of the last chunk
+
+    :param list patients: patients of the chunk
+    :param times: start times of the intervals in nanoseconds
+    :param values: feature values (patients x intervals x features, nan = no value in the interval)
+    :param dict carry: carried values of the last chunk {patient: (values, sample times)}, updated for the next chunk
+    :param int interval: nanoseconds of an interval, the values are stale at the end of the interval
+    :return: patients, aligned feature values (patients x intervals x features), boolean matrix of the intervals with
+             a new value (patients x intervals), boolean matrix of the intervals to predict (patients x intervals)
+    """
+    all_patients = sorted(set(patients) | set(carry))
+    rows = {patient: row for row, patient in enumerate(all_patients)}
+    chunk_values = np.full((len(all_patients),) + values.shape[1:], np.nan)
+    chunk_values[[rows[patient] for patient in patients]] = values
+    first_values = np.full((len(all_patients), values.shape[2]), np.nan)
+    first_times = np.zeros((len(all_patients), values.shape[2]), dtype=np.int64)
+    for patient, (carried_values, carried_times) in carry.items():
+        first_values[rows[patient]], first_times[rows[patient]] = carried_values, carried_times
+    sampled = ~np.isnan(chunk_values)
+    # Position of the latest value of every feature in every interval, -1 = the carried value
+    positions = np.maximum.accumulate(np.where(sampled, np.arange(len(times))[:, np.newaxis], -1), axis=1)
+    aligned = np.where(positions >= 0, np.take_along_axis(chunk_values, np.maximum(positions, 0), axis=1),
+                       first_values[:, np.newaxis])
+    sample_times = np.maximum.accumulate(np.maximum(np.where(sampled, times[:, np.newaxis], 0),
+                                                    first_times[:, np.newaxis]), axis=1)
+    fresh = ~np.isnan(aligned)
+    if health_data_max_age is not None:
+        fresh &= times[:, np.newaxis] + interval - sample_times <= health_data_max_age * 1000000000
+    for patient, row in rows.items():
+        carry[patient] = (aligned[row, -1], sample_times[row, -1])
+    # Like the live prediction: only complete and fresh values, and only intervals with a new value
+    return all_patients, aligned, sampled.any(axis=2), fresh.all(axis=2) & sampled.any(axis=2)
+
+
+def run_backfill():
+    """ Start the backfill of the predictions
+    """
+    try:
+        log.info('CONNECTING TO THE DATABASE SERVER...')
+        influxdb_client = database_connection()
+        log.info('CONNECTING TO THE DATABASE SERVER SUCCESSFULLY')
+
+        model = ModelRegistry(model_registry_path, model_features).load(model_version)
+        feature_fetcher = HealthFeatureFetcher(health_data, health_data_field, health_data_max_age, patient_tag)
+        disease_column = model.positive_column
+        interval = backfill_interval * 1000000000
+        start = parse_time(backfill_start) // interval * interval # Aligned to the grid of the database
+        end = parse_time(backfill_end) if backfill_end is not None else None
+        path = checkpoint_path.format(model_version=model.version)
+        checkpoint = load_checkpoint(path, model.version, start, end)
+        next_start, end, carry = checkpoint if checkpoint is not None else (start, end or time.time_ns(), {})
+        if checkpoint is not None:
+            log.info('RESUME BACKFILL OF MODEL VERSION %s FROM %s' % (
+                model.version, datetime.fromtimestamp(next_start / 1000000000, timezone.utc).isoformat()))
+        elif health_data_max_age is not None:
+            # Values sampled before the start, which are not stale at the start (e.g. the age)
+            log.info('READ VALUES BEFORE THE START...')
+            lookback_start = (start - health_data_max_age * 1000000000) // interval * interval
+            carry_forward(*feature_fetcher.fetch_window(influxdb_client, read_database_name, lookback_start, start,
+                                                        backfill_interval), carry, interval)
+            log.info('READ VALUES OF %s PATIENTS BEFORE THE START SUCCESSFULLY' % len(carry))
+        chunk = chunk_duration // backfill_interval * interval
+        chunks = -(-(end - start) // chunk)
+        while next_start < end:
+            chunk_start, chunk_end = next_start, min(next_start + chunk, end)
+            log.info('BACKFILL CHUNK %s OF %s...' % ((chunk_start - start) // chunk + 1, chunks))
+            patients, times, values = feature_fetcher.fetch_window(influxdb_client, read_database_name, chunk_start,
+                                                                   chunk_end, backfill_interval)
+            patients, features, sampled, complete = carry_forward(patients, times, values, carry, interval)
+            log.debug('%s PATIENTS, %s INTERVALS WITH NEW VALUES, %s TO PREDICT' % (
+                len(patients), int(sampled.sum()), int(complete.sum())))
+            points = 0
+            if complete.any():
+                rows, columns = np.nonzero(complete)
+                # One batch of all predictions of the chunk
+                probabilities = model.predict_proba(features[rows, columns])
+                predictions = model.classes_[probabilities.argmax(axis=1)]
+                formated_data = []
+                for row, column, prediction, probability in zip(rows.tolist(), columns.tolist(), predictions.tolist(),
+                                                                probabilities[:, disease_column].tolist()):
+                    tags = {
+                        'scriptVersion': version,
+                        'classifiere': model.classifier_name,
+                        'modelVersion': model.version
+                    }
+                    if patients[row]:
+                        tags[patient_tag] = patients[row]
+                    formated_data.append({
+                        'measurement': measurement_name,
+                        'time': int(times[column]) + interval, # End of the interval, like the live prediction
+                        'tags': tags,
+                        'fields': {
+                            'prediction': bool(prediction),
+                            'probability': probability,
+                            'percentage': model.score
+                        }
+                    })
+                influxdb_client.write_points(formated_data, time_precision='n', database=write_database_name,
+                                             batch_size=write_batch_size)
+                points = len(formated_data)
+            next_start = chunk_end
+            save_checkpoint(path, model.version, start, end, next_start, carry)
+            log.info('BACKFILL CHUNK %s OF %s WITH %s PREDICTIONS SUCCESSFULLY' % (
+                (chunk_start - start) // chunk + 1, chunks, points))
+        log.info('BACKFILL OF MODEL VERSION %s SUCCESSFULLY' % model.version)
+    except Exception as e:
+        log.error('BACKFILL FATAL ERROR: ' + str(e))
+
+
+if __name__ == "__main__":
+    run_backfill()
@@ -0,0 +1,144 @@
+# !DOCUMENTATION SPHINX STYLE
+
+# -*- PingMyHealth -*-
+# Rik Wachner - 1720651 - PingMyHealth Project 2020 - IIT
+
+"""
+PingMyHealth prediction cache
+----------------------------------------------------------------------------
+
+LRU cache of the predicted class probabilities, keyed on the model version
+and the quantised feature vector. Repeated feature vectors (most values of
+a patient are static) skip the neighbour search of the model
+
+"""
+from collections import OrderedDict
+import numpy as np
+import time
+
+
+class PredictionCache(object):
+    """ LRU cache with size and TTL eviction
+    """
+
+    def __init__(self, max_size=10000, ttl=3600, quantum=1, heartbeat=None, clock=time.monotonic):
+        """
+        :param int max_size: maximum cached feature vectors, the least recently used are evicted first
+        :param float ttl: seconds after which a cached prediction is evicted
+        :param quantum: quantum of the features (scalar or one per feature), values in the same quantum share a key
+        :param float heartbeat: seconds after which an unchanged prediction is written again, None = always write
+        :param function clock: monotonic clock in seconds
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.quantum = np.asarray(quantum, dtype=np.float64)
+        self.heartbeat = heartbeat
+        self.clock = clock
+        self.entries = OrderedDict() # {key: (probabilities, stored)}
+        self.written = {} # Last written prediction of every patient {patient: (key, written)}
+        self.hits = 0
+        self.misses = 0
+
+    def keys(self, version, features):
+        """ Get the keys of the feature vectors
+
+        :param string version: model version
+        :param features: feature matrix (one row per feature vector)
+        :return: list of the keys
+        """
+        quantised = np.round(np.asarray(features, dtype=np.float64) / self.quantum).astype(np.int64)
+        return [(version,) + tuple(row) for row in quantised.tolist()]
+
+    def lookup(self, keys, classes):
+        """ Get the cached predictions
+
+        :param list keys: keys of the feature vectors
+        :param int classes: count of the classes of the model
+        :return: class probabilities (rows of the misses are nan), boolean array of the hits
+        """
+        now = self.clock()
+        probabilities = np.full((len(keys), classes), np.nan)
+        hits = np.zeros(len(keys), dtype=bool)
+        for row, key in enumerate(keys):
+            entry = self.entries.get(key)
+            if entry is None:
+                continue
+            if now - entry[1] > self.ttl:
+                del self.entries[key]
+                continue
+            self.entries.move_to_end(key)
+            probabilities[row] = entry[0]
+            hits[row] = True
+        self.hits += int(hits.sum())
+        self.misses += len(keys) - int(hits.sum())
+        return probabilities, hits
+
+    def store(self, keys, probabilities):
+        """ Cache the predictions
+
+        :param list keys: keys of the feature vectors
+        :param probabilities: class probabilities (one row per key)
+        """
+        now = self.clock()
+        for key, row in zip(keys, np.asarray(probabilities)):
+            self.entries[key] = (row, now)
+            self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def predict(self, version, features, predict_proba, classes):
+        """ Get the predictions of the feature vectors, only the missing feature vectors are predicted
+
+        Feature vectors with the same key are predicted only once
+
+        :param string version: model version
+        :param features: feature matrix (one row per feature vector)
+        :param function predict_proba: class probabilities of a feature matrix, e.g. of the model
+        :param int classes: count of the classes of the model
+        :return: keys of the feature vectors, class probabilities (one row per feature vector)
+        """
+        keys = self.keys(version, features)
+        probabilities, hits = self.lookup(keys, classes)
+        if not hits.all():
+            rows = {}
+            for row in np.flatnonzero(~hits).tolist():
+                rows.setdefault(keys[row], []).append(row)
+            first_rows = [key_rows[0] for key_rows in rows.values()]
+            predicted = predict_proba(np.asarray(features)[first_rows])
+            for key_rows, row_probabilities in zip(rows.values(), predicted):
+                probabilities[key_rows] = row_probabilities
+            self.store(list(rows), predicted)
+        return keys, probabilities
+
+    def unchanged(self, patient, key):
+        """ Check, if the prediction of a patient was already written with the same key
+
+        :param string patient: patient of the prediction
+        :param tuple key: key of the feature vector
+        :return: True, if the write can be skipped
+        """
+        if self.heartbeat is None or patient not in self.written:
+            return False
+        written_key, written = self.written[patient]
+        return written_key == key and self.clock() - written < self.heartbeat
+
+    def mark_written(self, patient, key):
+        """ Remember the written prediction of a patient
+
+        :param string patient: patient of the prediction
+        :param tuple key: key of the feature vector
+        """
+        self.written[patient] = (key, self.clock())
+
+    def statistics(self):
+        """ Get the statistics of the cache
+
+        :return: dictionary of the statistics
+        """
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRatio': self.hits / lookups if lookups else 0.0
+        }
@@ -0,0 +1,68 @@
+# !DOCUMENTATION SPHINX STYLE
+
+# -*- PingMyHealth -*-
+# Rik Wachner - 1720651 - PingMyHealth Project 2020 - IIT
+
+"""
+PingMyHealth Append Training Data
+----------------------------------------------------------------------------
+
+Append new labelled health data to the neighbour index of the latest model
+and save it as new version into the model registry, without refit of the
+model. The scaler and the test score stay those of the trained model
+
+"""
+from datetime import datetime, timezone
+import pandas as pd
+
+from ModelRegistry import ModelRegistry, new_version
+
+# ----------------------------------------------------------------------- #
+# LOGGING                                                                 #
+# ----------------------------------------------------------------------- #
+import logging
+
+logging.basicConfig()
+log = logging.getLogger()
+log.setLevel(logging.DEBUG)
+
+# ----------------------------------------------------------------------- #
+# PARAMS                                                                  #
+# ----------------------------------------------------------------------- #
+training_data_path = "../new_heart_data.csv" # New labelled health data with the feature columns and "target"
+feature_columns = ["age", "sex", "trestbps", "chol", "thalach"] # Feature columns in the order of the services
+model_registry_path = "../model_registry" # Model registry of the machine learning environment
+model_version = None # Version of the extended model, None = the current time
+merge_index = True # Merge the delta buffer into the index before saving, the services load a complete index
+
+
+def append_training_data():
+    """ Append the new labelled health data to the latest model
+    """
+    try:
+        log.info('LOAD CSV DATA...')
+        df = pd.read_csv(training_data_path)
+        log.info('LOAD %s ROWS OF CSV DATA SUCCESSFULLY' % len(df))
+
+        model_registry = ModelRegistry(model_registry_path, feature_columns, mmap_mode=None)
+        artifact = model_registry.load()
+
+        log.info('APPEND TRAINING DATA TO MODEL VERSION %s...' % artifact.version)
+        artifact.append(df[feature_columns].values, df["target"].values)
+        if merge_index:
+            artifact.classifier.merge()
+        log.info('APPEND TRAINING DATA TO MODEL VERSION %s SUCCESSFULLY' % artifact.version)
+
+        log.info('SAVE MODEL INTO THE MODEL REGISTRY...')
+        artifact.version = model_version or new_version()
+        artifact.created = datetime.now(timezone.utc).isoformat()
+        model_registry.save(artifact)
+        log.info('SAVE MODEL VERSION %s WITH %s TRAINING SAMPLES SUCCESSFULLY' % (
+            artifact.version, len(artifact.classifier)))
+        return artifact
+    except Exception as e:
+        log.error('APPEND ERROR: ' + str(e))
+
+
+if __name__ == "__main__":
+    append_training_data()
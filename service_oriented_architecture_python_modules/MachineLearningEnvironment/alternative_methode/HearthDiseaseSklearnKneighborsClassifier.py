@@ -12,8 +12,12 @@ Simple machine learning environment to use a model and save the result
 """
 from datetime import datetime, timezone
 from influxdb import InfluxDBClient
-import time
-import joblib
+import numpy as np
+
+from FixedRateScheduler import FixedRateScheduler
+from HealthFeatureFetcher import HealthFeatureFetcher
+from PredictionCache import PredictionCache
+from ModelRegistry import ModelRegistry
 
 # ----------------------------------------------------------------------- #
 # LOGGING                                                                 #
@@ -28,27 +32,29 @@ log.setLevel(logging.DEBUG)
 # PARAMS                                                                  #
 # ----------------------------------------------------------------------- #
 version = "1.0.0"
-model_version = "1.0.0"
 influxdb_server_host, influxdb_server_port = "localhost", 8086
 write_database_name = "ml_environment_db"
 read_database_name = "modbus_i_o_db"
-model_classifier = "sklearn_KNeighborsClassifier"
+model_registry_path = "../model_registry" # Versions of the trained models, the LATEST version is used
+model_features = ["age", "sex", "trestbps", "chol", "thalach"] # Training columns of the health data values
 measurement_name = "hearth_disease_prediction"
-model_score = 0.82
 data_sampling_rate = 60
-# Dictionary which includes ALL needed prediction Values (from the database)
-health_data = {
-    "fitnessband_input_register": ["Age", "Sex", "Pulse", "Systolic blood pressure value"],
-    "cholesterin_fastchecker_input_register": ["Cholesterin"]
-}
+# ALL needed prediction values (from the database) in the order of the training columns
+# age, sex, trestbps (resting blood pressure), chol (cholesterin), thalach (maximum heart rate)
+health_data = [
+    ("fitnessband_input_register", "Age"),
+    ("fitnessband_input_register", "Sex"),
+    ("fitnessband_input_register", "Systolic blood pressure value"),
+    ("cholesterin_fastchecker_input_register", "Cholesterin"),
+    ("fitnessband_input_register", "Pulse")
+]
 health_data_field = 'valueScaled'
-
-
-def initialize_model():
-    """ Initialize the sklearn kneighborsclassifier model with hearth disease dataset
-    """
-    model = joblib.load('trained_model.pkl')
-    return model
+health_data_max_age = 2 * 3600 # Seconds after which a value is stale, e.g. the age is polled every hour
+patient_tag = "device" # Tag of the patients, every patient gets an own prediction, None = one patient
+prediction_cache_size = 10000 # Cached predictions, the least recently used are evicted first
+prediction_cache_ttl = 3600 # Seconds after which a cached prediction is evicted
+prediction_cache_quantum = [1, 1, 1, 1, 1] # Quantum of every value, values in the same quantum share a prediction
+prediction_heartbeat = 600 # Seconds after which an unchanged prediction is written again, None = always write
 
 
 def database_connection():
@@ -68,45 +74,69 @@ def run_server():
         log.info('CONNECTING TO THE DATABASE SERVER SUCCESSFULLY')
 
         log.info('USE KNEIGHBORSCLASSIFIER MODEL...')
-        model = initialize_model()
-        log.info('USE KNEIGHBORSCLASSIFIER MODEL SUCCESSFULLY')
-
+        # The model of TrainHearthDiseaseSklearnKneighborsClassifierModel.py with its scaler
+        model_registry = ModelRegistry(model_registry_path, model_features)
+        model = model_registry.load()
+        log.info('USE KNEIGHBORSCLASSIFIER MODEL VERSION %s SUCCESSFULLY' % model.version)
+
+        feature_fetcher = HealthFeatureFetcher(health_data, health_data_field, health_data_max_age, patient_tag)
+        log.debug(feature_fetcher.query)
+        prediction_cache = PredictionCache(prediction_cache_size, prediction_cache_ttl, prediction_cache_quantum,
+                                           prediction_heartbeat)
+        scheduler = FixedRateScheduler('MACHINE LEARNING ENVIRONMENT', data_sampling_rate)
         while True:
+            model = model_registry.reload(model) # Use a new model version from the next prediction on
             log.info('READ DATABASE DATA..')
-            influxdb_client.switch_database(read_database_name)
-            values = []
-            for measurement in health_data:
-                for description in health_data[measurement]:
-                    python_generator_iterator = influxdb_client.query(
-                        "SELECT * FROM " + measurement + " GROUP BY * ORDER BY DESC LIMIT 1").get_points(
-                        tags={'description': description})
-                    for value in python_generator_iterator:
-                        values.append(value[health_data_field])
-            log.info('READ DATABASE DATA SUCCESSFULLY')
-            log.debug(values)
-            prediction = bool(model.predict([values]))
-            log.debug("PREDICTION: POSSIBLE HEARTH DISEASE = %r WITH %s %%" % (prediction, model_score))
-            log.info('STARTING TO FORMAT COLLECTED DATA FOR THE DATABASE...')
-            timestamp = datetime.now(timezone.utc)
-            formated_data = [{
-                'measurement': measurement_name,
-                'time': timestamp,
-                'tags': {
-                    'scriptVersion': version,
-                    'classifiere': model_classifier,
-                    'modelVersion': model_version
-                },
-                'fields': {
-                    'prediction': prediction,
-                    'percentage': model_score
-                }
-            }]
-            log.debug(formated_data)
-            log.info('WRITE FORMATED DATA TO THE DATABASE...')
-            influxdb_client.switch_database(write_database_name)
-            influxdb_client.write_points(formated_data)
-            log.info('WRITING TO THE DATABASE SERVER SUCCESSFULLY')
-            time.sleep(data_sampling_rate)
+            patients, features, missing, stale = feature_fetcher.fetch(influxdb_client, read_database_name)
+            log.info('READ DATABASE DATA OF %s PATIENTS SUCCESSFULLY' % len(patients))
+            log.debug(features)
+            # A prediction of incomplete or old values would be wrong, so these patients get no prediction
+            complete = ~(missing | stale).any(axis=1)
+            for row in np.flatnonzero(~complete).tolist():
+                log.warning('NO PREDICTION FOR PATIENT %r, MISSING VALUES: %s, STALE VALUES: %s' % (
+                    patients[row], feature_fetcher.feature_names(missing[row]),
+                    feature_fetcher.feature_names(stale[row])))
+            if complete.any():
+                complete_patients = [patients[row] for row in np.flatnonzero(complete)]
+                # One neighbour search for all patients, whose values are not in the cache
+                keys, probabilities = prediction_cache.predict(model.version, features[complete], model.predict_proba,
+                                                               len(model.classes_))
+                log.debug('PREDICTION CACHE: %s' % prediction_cache.statistics())
+                predictions = model.classes_[probabilities.argmax(axis=1)]
+                disease_column = model.positive_column
+                log.info('STARTING TO FORMAT COLLECTED DATA FOR THE DATABASE...')
+                timestamp = datetime.now(timezone.utc)
+                formated_data = []
+                for patient, key, prediction, probability in zip(complete_patients, keys, predictions.tolist(),
+                                                                 probabilities[:, disease_column].tolist()):
+                    if prediction_cache.unchanged(patient, key):
+                        continue # The same prediction of the same values is already in the database
+                    prediction_cache.mark_written(patient, key)
+                    log.debug("PREDICTION: POSSIBLE HEARTH DISEASE OF PATIENT %r = %r WITH %s %%" % (
+                        patient, bool(prediction), model.score))
+                    tags = {
+                        'scriptVersion': version,
+                        'classifiere': model.classifier_name,
+                        'modelVersion': model.version
+                    }
+                    if patient:
+                        tags[patient_tag] = patient
+                    formated_data.append({
+                        'measurement': measurement_name,
+                        'time': timestamp,
+                        'tags': tags,
+                        'fields': {
+                            'prediction': bool(prediction),
+                            'probability': probability,
+                            'percentage': model.score
+                        }
+                    })
+                if formated_data:
+                    log.debug(formated_data)
+                    log.info('WRITE %s FORMATED PREDICTIONS TO THE DATABASE...' % len(formated_data))
+                    influxdb_client.write_points(formated_data, database=write_database_name)
+                    log.info('WRITING TO THE DATABASE SERVER SUCCESSFULLY')
+            scheduler.wait() # Wait for the next prediction on the fixed rate grid
     except Exception as e:
         log.error('SERVER FATAL ERROR: ' + str(e))
 
@@ -7,15 +7,25 @@
 PingMyHealth Train Model
 ----------------------------------------------------------------------------
 
-Simple machine learning environment to train a model and save it as pickle
+Simple machine learning environment to train a model and save it as new
+version into the model registry
+
+The neighbours, the weighting and the metric are searched with a k-fold
+cross validation in a process pool. The folds are scaled once and shared
+by all candidates, every worker searches the neighbours of a fold and a
+metric once for the largest k and reuses them for all other candidates
 
 """
-from sklearn.model_selection import train_test_split
-from sklearn.neighbors import KNeighborsClassifier
+from sklearn.model_selection import ParameterGrid, ParameterSampler, StratifiedKFold, train_test_split
 from sklearn.preprocessing import StandardScaler
+import multiprocessing
 import pandas as pd
+import numpy as np
 import time
-import joblib
+import os
+
+from ModelRegistry import ModelArtifact, ModelRegistry, new_version
+from NeighbourIndex import NeighbourIndexClassifier, vote
 
 # ----------------------------------------------------------------------- #
 # LOGGING                                                                 #
@@ -29,26 +39,140 @@ log.setLevel(logging.DEBUG)
 # ----------------------------------------------------------------------- #
 # PARAMS                                                                  #
 # ----------------------------------------------------------------------- #
-# NONE
+training_data_path = "../heart.csv" # https://www.kaggle.com/johnsmith88/heart-disease-dataset/data
+feature_columns = ["age", "sex", "trestbps", "chol", "thalach"] # Feature columns in the order of the services
+model_registry_path = "../model_registry" # Model registry of the machine learning environment
+model_version = None # Version of the trained model, None = the training time
+neighbour_algorithm = "kd_tree" # Neighbour index: "brute", "kd_tree", "ball_tree" or "ivf" (approximate)
+search_space = {
+    "n_neighbors": list(range(1, 31)),
+    "weights": ["uniform", "distance"],
+    "metric": ["euclidean", "manhattan", "chebyshev"]
+} # Candidates of the search
+search_method = "grid" # "grid" = all candidates, "random" = random_candidates random candidates
+random_candidates = 30
+cv_folds = 5 # Folds of the cross validation
+test_size = 0.25 # Held out test data of the final score, never seen by the search
+search_processes = None # Processes of the search, None = all CPUs
+random_state = None # Seed of the splits and the random search, None = random
+model_compress = 0 # joblib compression of the model, 0 = uncompressed (memory mapped), 1-3 = lightly compressed
+search_results_file_name = "search_results.csv" # Candidates of the search, stored next to the model version
+
+worker_folds = None # Scaled folds of a search worker [(train samples, train labels, test samples, test labels), ...]
+worker_max_neighbors = None # Largest k of the search
+worker_neighbours = {} # Neighbours of a search worker {(fold, metric): (distances, labels, classes)}
+
+
+def scaled_folds(samples, labels):
+    """ Split the training data into the folds of the cross validation and scale every fold like the model
+
+    :param samples: training samples
+    :param labels: training labels
+    :return: list of the folds [(train samples, train labels, test samples, test labels), ...]
+    """
+    folds = []
+    for train, test in StratifiedKFold(cv_folds, shuffle=True, random_state=random_state).split(samples, labels):
+        scaler = StandardScaler().fit(samples[train])
+        folds.append((scaler.transform(samples[train]), labels[train], scaler.transform(samples[test]), labels[test]))
+    return folds
+
+
+def initialize_worker(folds, max_neighbors):
+    """ Initialize a search worker with the scaled folds, which are sent once per worker, not per candidate
+
+    :param list folds: scaled folds
+    :param int max_neighbors: largest k of the search
+    """
+    global worker_folds, worker_max_neighbors
+    worker_folds = folds
+    worker_max_neighbors = max_neighbors
+    worker_neighbours.clear()
+
+
+def fold_neighbours(fold, metric):
+    """ Get the neighbours of the test samples of a fold for the largest k, the first k neighbours of them are the
+    neighbours of every smaller k
+
+    :param int fold: number of the fold
+    :param string metric: distance metric
+    :return: distances and labels of the neighbours, classes
+    """
+    train_samples, train_labels, test_samples, test_labels = worker_folds[fold]
+    if (fold, metric) not in worker_neighbours:
+        model = NeighbourIndexClassifier(n_neighbors=worker_max_neighbors, metric=metric, algorithm=neighbour_algorithm)
+        model.fit(train_samples, train_labels)
+        worker_neighbours[(fold, metric)] = model.kneighbors(test_samples) + (model.classes_,)
+    return worker_neighbours[(fold, metric)]
+
+
+def evaluate_candidate(candidate):
+    """ Cross validate one candidate (task of a search worker)
+
+    :param dict candidate: parameters of the classifier
+    :return: candidate, mean score, standard deviation of the scores, seconds of the worker
+    """
+    start = time.perf_counter()
+    scores = []
+    for fold in range(len(worker_folds)):
+        distances, labels, classes = fold_neighbours(fold, candidate["metric"])
+        k = candidate["n_neighbors"]
+        probabilities = vote(distances[:, :k], labels[:, :k], len(classes), candidate["weights"])
+        scores.append(np.mean(classes[probabilities.argmax(axis=1)] == worker_folds[fold][3]))
+    return candidate, float(np.mean(scores)), float(np.std(scores)), time.perf_counter() - start
+
+
+def search_candidates(samples, labels):
+    """ Cross validate all candidates in a process pool
+
+    :param samples: training samples
+    :param labels: training labels
+    :return: data frame of the candidates sorted by the score
+    """
+    if search_method == "grid":
+        candidates = list(ParameterGrid(search_space))
+    elif search_method == "random":
+        candidates = list(ParameterSampler(search_space, random_candidates, random_state=random_state))
+    else:
+        raise ValueError('%s IS NOT A VALID SEARCH METHOD' % search_method)
+    folds = scaled_folds(samples, labels)
+    max_neighbors = max(candidate["n_neighbors"] for candidate in candidates)
+    log.info('SEARCH %s CANDIDATES WITH %s FOLDS...' % (len(candidates), cv_folds))
+    results = []
+    # The candidates of the same metric share the cached neighbours of a worker
+    candidates.sort(key=lambda candidate: candidate["metric"])
+    with multiprocessing.Pool(search_processes, initializer=initialize_worker, initargs=(folds, max_neighbors)) as pool:
+        for candidate, score, score_std, seconds in pool.imap_unordered(evaluate_candidate, candidates):
+            log.debug('CANDIDATE %s: SCORE %.4f +- %.4f IN %.3f S' % (candidate, score, score_std, seconds))
+            results.append(dict(candidate, score=score, score_std=score_std, seconds=seconds))
+    results = pd.DataFrame(results).sort_values(["score", "score_std"], ascending=[False, True], ignore_index=True)
+    log.info('SEARCH %s CANDIDATES SUCCESSFULLY' % len(candidates))
+    return results
+
 
 def initialize_model():
     """ Initialize the sklearn kneighborsclassifier model with hearth disease dataset
     """
     try:
         log.info('LOAD CSV DATA...')
-        df = pd.read_csv("hearth.csv")
+        df = pd.read_csv(training_data_path)
         log.info('DATA SOURCE: https://www.kaggle.com/johnsmith88/heart-disease-dataset/data')
         log.info('LOAD CSV DATA SUCCESSFULLY')
 
         log.info('TRANSFORM X_Y_N and Z FROM DATAFRAME...')
-        X_Y_N = df[["age", "sex", "trestbps", "chol", "thalach"]].values
+        X_Y_N = df[feature_columns].values
         Z = df["target"].values
         log.info('TRANSFORM X_Y_N and Z FROM SUCCESSFULLY...')
 
         log.info('SPLIT TRAIN AND TEST DATA...')
-        X_Y_N_train, X_Y_N_test, Z_train, Z_test = train_test_split(X_Y_N, Z, test_size=0.25)
+        X_Y_N_train, X_Y_N_test, Z_train, Z_test = train_test_split(X_Y_N, Z, test_size=test_size, stratify=Z,
+                                                                    random_state=random_state)
         log.info('SPLIT TRAIN AND TEST DATA SUCCESSFULLY')
 
+        results = search_candidates(X_Y_N_train, Z_train)
+        best = results.iloc[0]
+        log.info('BEST CANDIDATE: N_NEIGHBORS %s, WEIGHTS %s, METRIC %s WITH SCORE %.4f' % (
+            best["n_neighbors"], best["weights"], best["metric"], best["score"]))
+
         log.info('SCALE DATA...')
         scaler = StandardScaler()
         scaler.fit(X_Y_N_train)
@@ -57,11 +181,20 @@ def initialize_model():
         log.info('SCALE DATA SUCCESSFULLY')
 
         log.info('BUILD AND TRAIN MODEL...')
-        model = KNeighborsClassifier(n_neighbors=4)
+        model = NeighbourIndexClassifier(n_neighbors=int(best["n_neighbors"]), weights=best["weights"],
+                                         metric=best["metric"], algorithm=neighbour_algorithm)
         model.fit(X_Y_N_train, Z_train)
         log.info('BUILD AND TRAIN MODEL SUCCESSFULLY')
-        joblib.dump(model, 'trained_model.pkl', compress=9)
-        return
+
+        log.info('SAVE MODEL INTO THE MODEL REGISTRY...')
+        # The scaler and the neighbour index are part of the model, the services scale the live values like the
+        # training data and search the stored index
+        artifact = ModelArtifact(model_version or new_version(), scaler, model, feature_columns,
+                                 model.score(X_Y_N_test, Z_test), "kneighbors_%s" % neighbour_algorithm)
+        path = ModelRegistry(model_registry_path).save(artifact, compress=model_compress)
+        results.to_csv(os.path.join(os.path.dirname(path), search_results_file_name), index=False)
+        log.info('SAVE MODEL VERSION %s WITH SCORE %s SUCCESSFULLY' % (artifact.version, artifact.score))
+        return artifact
     except Exception as e:
         log.error('INITIALISATION ERROR: ' + str(e))
 
@@ -0,0 +1,125 @@
+# !DOCUMENTATION SPHINX STYLE
+
+# -*- PingMyHealth -*-
+# Rik Wachner - 1720651 - PingMyHealth Project 2020 - IIT
+
+"""
+PingMyHealth influxdb line protocol encoder
+----------------------------------------------------------------------------
+
+Precompiled line protocol encoder for the register values of the modbus
+clients, which escapes the measurement and tags of every register only once
+
+"""
+import io
+
+
+def escape_measurement(measurement):
+    """ Escape a measurement name for the line protocol
+
+    :param string measurement: measurement name
+    :return: escaped measurement name
+    """
+    return str(measurement).replace('\\', '\\\\').replace(',', '\\,').replace(' ', '\\ ')
+
+
+def escape_tag(tag):
+    """ Escape a tag key or tag value for the line protocol
+
+    :param string tag: tag key or tag value
+    :return: escaped tag key or tag value
+    """
+    return escape_measurement(tag).replace('=', '\\=')
+
+
+class LineProtocolEncoder(object):
+    """ Encode the per register results into one line protocol batch
+
+    The escaped measurement and tags of every register are built once, when the register maps are loaded. Per
+    cycle only the field values and the timestamp are appended into one reusable buffer
+    """
+
+    def __init__(self, register_maps, tags, device=None):
+        """
+        :param list register_maps: register maps [{register name: [(adress, name, scale, ...), ...]}, ...]
+        :param dict tags: tags of every point, e.g. the script version
+        :param string device: device name of the register maps, None = no device tag
+        """
+        self.tags = tags
+        self.prefixes = {}
+        self.buffer = io.StringIO()
+        self.add_register_maps(register_maps, device)
+
+    def add_register_maps(self, register_maps, device=None):
+        """ Build the escaped measurement and tags of all register entries of the register maps
+
+        :param list register_maps: register maps [{register name: [(adress, name, scale, ...), ...]}, ...]
+        :param string device: device name of the register maps, None = no device tag
+        """
+        for register_map in register_maps:
+            for register in register_map:
+                for register_entry in register_map[register]:
+                    self.prefix(device, register, register_entry)
+
+    def prefix(self, device, register, register_entry):
+        """ Get the escaped measurement and tags of a register entry
+
+        :param string device: device name, None = no device tag
+        :param string register: register name
+        :param tuple register_entry: register entry (adress, name, scale, ...)
+        :return: escaped measurement and tags followed by a space
+        """
+        key = (device, register, register_entry)
+        prefix = self.prefixes.get(key)
+        if prefix is None:
+            tags = dict(self.tags, register=register_entry[0], description=register_entry[1])
+            if device is not None:
+                tags['device'] = device
+            # The database stores the tags sorted by key, sorted tags save it the work
+            prefix = escape_measurement(register) + ''.join(
+                ',%s=%s' % (escape_tag(key), escape_tag(value)) for key, value in sorted(tags.items())
+                if value is not None and value != '') + ' '
+            self.prefixes[key] = prefix
+        return prefix
+
+    def encode(self, result, timestamp, device=None):
+        """ Encode the per register results of one cycle
+
+        :param dict result: per register results {register name: {register entry: [value]}}
+        :param int timestamp: timestamp in nanoseconds
+        :param string device: device name, None = no device tag
+        :return: line protocol batch and count of lines
+        """
+        self.reset()
+        line_count = self.append(result, timestamp, device)
+        return self.getvalue(), line_count
+
+    def append(self, result, timestamp, device=None):
+        """ Append the per register results to the current batch, e.g. of several devices
+
+        :param dict result: per register results {register name: {register entry: [value]}}
+        :param int timestamp: timestamp in nanoseconds
+        :param string device: device name, None = no device tag
+        :return: count of appended lines
+        """
+        write = self.buffer.write
+        line_count = 0
+        for register in result:
+            for register_entry, values in result[register].items():
+                write('%svalue=%di,valueScaled=%r %d\n' % (self.prefix(device, register, register_entry), values[0],
+                                                            values[0] / register_entry[2], timestamp))
+                line_count += 1
+        return line_count
+
+    def reset(self):
+        """ Start a new batch
+        """
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+    def getvalue(self):
+        """ Get the current batch
+
+        :return: line protocol batch
+        """
+        return self.buffer.getvalue()
@@ -0,0 +1,203 @@
+# !DOCUMENTATION SPHINX STYLE
+
+# -*- PingMyHealth -*-
+# Rik Wachner - 1720651 - PingMyHealth Project 2020 - IIT
+
+"""
+PingMyHealth influxdb write buffer
+----------------------------------------------------------------------------
+
+Store and forward buffer (SQLite write-ahead queue) for database writes,
+which failed while the database was not available
+
+"""
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+import sqlite3
+import threading
+import time
+
+# ----------------------------------------------------------------------- #
+# LOGGING                                                                 #
+# ----------------------------------------------------------------------- #
+import logging
+
+log = logging.getLogger()
+
+
+def is_rejected(error):
+    """ Check, if the database rejected a batch (4xx, e.g. a malformed line), a retry of the same batch fails again
+
+    Connection errors and server errors (5xx) are not rejections, the batch is retried
+
+    :param Exception error: error of a database write
+    :return: True, if the batch is rejected
+    """
+    if isinstance(error, InfluxDBServerError) or not isinstance(error, InfluxDBClientError):
+        return False
+    return error.code is not None and 400 <= error.code < 500
+
+
+class InfluxDBWriteBuffer(object):
+    """ Write points to the database or, if that fails, into a local SQLite queue
+
+    A background thread drains the queue in large batches with an exponential backoff, as soon as the database
+    is available again. While the queue is not empty, new batches are queued directly, so the polling does not
+    wait for a database which is not reachable
+
+    Batches, which the database rejects (4xx), are not retried, but moved into the table rejected_batches of the
+    SQLite queue, so they do not block the batches behind them
+    """
+
+    def __init__(self, influxdb_client, flusher_client, path, max_bytes=256 * 1024 * 1024, max_age=7 * 24 * 3600,
+                 flush_batch_size=5000, backoff_min=1, backoff_max=300):
+        """
+        :param InfluxDBClient influxdb_client: database connection of the writing thread
+        :param InfluxDBClient flusher_client: own database connection of the background flusher
+        :param string path: file of the SQLite queue
+        :param int max_bytes: maximum size of all queued batches, the oldest batches are dropped first
+        :param float max_age: seconds after which queued batches are dropped
+        :param int flush_batch_size: maximum lines per database write of the background flusher
+        :param float backoff_min: first seconds to wait after a failed flush
+        :param float backoff_max: maximum seconds to wait after a failed flush
+        """
+        self.influxdb_client = influxdb_client
+        self.flusher_client = flusher_client
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.flush_batch_size = flush_batch_size
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.lock = threading.Lock()
+        self.pending = threading.Event()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS batches (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                                    'created REAL, line_count INTEGER, lines TEXT)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS rejected_batches (id INTEGER PRIMARY KEY '
+                                    'AUTOINCREMENT, created REAL, line_count INTEGER, lines TEXT, error TEXT)')
+            self.buffered_bytes = self.connection.execute(
+                'SELECT COALESCE(SUM(LENGTH(lines)), 0) FROM batches').fetchone()[0]
+        if self.buffered_bytes:
+            log.info('WRITE BUFFER CONTAINS %s BYTES FROM A FORMER RUN' % self.buffered_bytes)
+            self.pending.set()
+        self.flusher = threading.Thread(target=self.run_flusher, name='InfluxDBWriteBufferFlusher', daemon=True)
+        self.flusher.start()
+
+    def write_lines(self, lines, line_count):
+        """ Write a line protocol batch to the database or queue it, if the database is not available
+
+        :param string lines: line protocol of the batch
+        :param int line_count: count of lines in the batch
+        """
+        if not self.pending.is_set():
+            try:
+                self.influxdb_client.write_points(lines, protocol='line')
+                return
+            except Exception as e:
+                if is_rejected(e):
+                    self.reject(lines, line_count, e)
+                    return
+                log.error('WRITING TO THE DATABASE SERVER FAILED, BUFFER DATA LOCALLY: ' + str(e))
+        self.store(lines, line_count)
+
+    def store(self, lines, line_count):
+        """ Append a batch to the queue and drop the oldest batches beyond the size and age caps
+
+        :param string lines: line protocol of the batch
+        :param int line_count: count of lines in the batch
+        """
+        with self.lock, self.connection:
+            self.connection.execute('INSERT INTO batches (created, line_count, lines) VALUES (?, ?, ?)',
+                                    (time.time(), line_count, lines))
+            self.buffered_bytes += len(lines)
+            self.drop_expired()
+        self.pending.set()
+
+    def reject(self, lines, line_count, error, ids=()):
+        """ Move a batch, which the database rejected, out of the queue
+
+        :param string lines: line protocol of the batch
+        :param int line_count: count of lines in the batch
+        :param Exception error: error of the database
+        :param list ids: ids of the batch in the queue, empty = not queued
+        """
+        log.error('DATABASE REJECTED A BATCH OF %s LINES, MOVED INTO THE REJECTED BATCHES: %s' % (line_count, error))
+        with self.lock, self.connection:
+            self.connection.execute('INSERT INTO rejected_batches (created, line_count, lines, error) '
+                                    'VALUES (?, ?, ?, ?)', (time.time(), line_count, lines, str(error)))
+            self.connection.executemany('DELETE FROM batches WHERE id = ?', [(i,) for i in ids])
+            self.buffered_bytes = self.connection.execute(
+                'SELECT COALESCE(SUM(LENGTH(lines)), 0) FROM batches').fetchone()[0]
+
+    def drop_expired(self):
+        """ Drop the batches beyond the size and age caps, the caller holds the lock
+        """
+        self.connection.execute('DELETE FROM rejected_batches WHERE created < ?', (time.time() - self.max_age,))
+        dropped = self.connection.execute('DELETE FROM batches WHERE created < ?',
+                                          (time.time() - self.max_age,)).rowcount
+        while self.buffered_bytes > self.max_bytes:
+            row = self.connection.execute('SELECT id, LENGTH(lines) FROM batches ORDER BY id LIMIT 1').fetchone()
+            if row is None:
+                break
+            self.connection.execute('DELETE FROM batches WHERE id = ?', (row[0],))
+            self.buffered_bytes -= row[1]
+            dropped += 1
+        if dropped:
+            self.buffered_bytes = self.connection.execute(
+                'SELECT COALESCE(SUM(LENGTH(lines)), 0) FROM batches').fetchone()[0]
+            log.warning('WRITE BUFFER DROPPED %s BATCHES BEYOND ITS SIZE OR AGE CAP' % dropped)
+
+    def next_batches(self, single=False):
+        """ Get the oldest queued batches up to the flush batch size
+
+        :param bool single: only the oldest batch, e.g. to find the batch, which the database rejected
+        :return: list of ids, the joined line protocol and the count of lines
+        """
+        ids, lines, line_count = [], [], 0
+        with self.lock, self.connection:
+            self.drop_expired()
+            for row in self.connection.execute('SELECT id, line_count, lines FROM batches ORDER BY id'):
+                if ids and (single or line_count + row[1] > self.flush_batch_size):
+                    break
+                ids.append(row[0])
+                line_count += row[1]
+                lines.append(row[2])
+        return ids, ''.join(lines), line_count
+
+    def run_flusher(self):
+        """ Drain the queue into the database, as soon as it is available again
+        """
+        backoff = self.backoff_min
+        single = False
+        while True:
+            self.pending.wait()
+            ids, lines, line_count = self.next_batches(single)
+            if not ids:
+                with self.lock:
+                    # Nothing new arrived since the last batch, so the direct writes can continue
+                    if self.connection.execute('SELECT COUNT(*) FROM batches').fetchone()[0] == 0:
+                        self.pending.clear()
+                        single = False
+                        log.info('WRITE BUFFER DRAINED')
+                continue
+            try:
+                self.flusher_client.write_points(lines, protocol='line')
+            except Exception as e:
+                if is_rejected(e):
+                    if len(ids) > 1:
+                        # One of the joined batches is rejected, flush them one by one to find it
+                        single = True
+                    else:
+                        self.reject(lines, line_count, e, ids)
+                        single = False
+                    continue
+                log.error('FLUSHING THE WRITE BUFFER FAILED, RETRY IN %s SECONDS: %s' % (backoff, str(e)))
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.backoff_max)
+                continue
+            backoff = self.backoff_min
+            with self.lock, self.connection:
+                self.connection.executemany('DELETE FROM batches WHERE id = ?', [(i,) for i in ids])
+                self.buffered_bytes = self.connection.execute(
+                    'SELECT COALESCE(SUM(LENGTH(lines)), 0) FROM batches').fetchone()[0]
+            log.info('FLUSHED %s BUFFERED BATCHES TO THE DATABASE' % len(ids))
@@ -0,0 +1,163 @@
+# !DOCUMENTATION SPHINX STYLE
+
+# -*- PingMyHealth -*-
+# Rik Wachner - 1720651 - PingMyHealth Project 2020 - IIT
+
+"""
+PingMyHealth asynchronous pymodbus client
+----------------------------------------------------------------------------
+
+Polling engine (pymodbus asyncio client) for reading the data of many
+modbus devices concurrently
+
+"""
+from ModbusClientMaster import database_connection, write_buffer_connection, version
+from ModbusClientMaster import modbus_input_registers, modbus_holding_registers
+from ModbusClientMaster import block_read_max_gap, block_read_max_count, data_sampling_rate
+from ModbusClientMaster import report_by_exception, register_deadbands, default_deadband, deadband_heartbeat
+from ModbusClientMaster import publish_samples
+from ModbusReadPlanner import read_register_map_async
+from ModbusDeadbandFilter import DeadbandFilter
+from InfluxDBLineProtocolEncoder import LineProtocolEncoder
+from pymodbus.client.asynchronous.async_io import AsyncioModbusTcpClient
+import asyncio
+import time
+
+from FixedRateScheduler import FixedRateScheduler
+from SampleChannel import SamplePublisher
+
+# ----------------------------------------------------------------------- #
+# LOGGING                                                                 #
+# ----------------------------------------------------------------------- #
+import logging
+
+logging.basicConfig()
+log = logging.getLogger()
+log.setLevel(logging.DEBUG)
+
+# ----------------------------------------------------------------------- #
+# PARAMS                                                                  #
+# ----------------------------------------------------------------------- #
+device_timeout = 5 # Default seconds a device may need for connecting and reading all registers
+
+# ----------------------------------------------------------------------- #
+# MODBUS DEVICES                                                          #
+# ----------------------------------------------------------------------- #
+modbus_devices = [
+    # name, host, port, unit, timeout (None = device_timeout), input register map, holding register map
+    ("pingmyhealth_simulation", "localhost", 502, 0, None, modbus_input_registers, modbus_holding_registers)
+]
+
+
+class ModbusDevice(object):
+    """ Asyncio modbus connection of one device, which reconnects after a failure
+    """
+
+    def __init__(self, name, host, port, unit, timeout, input_registers, holding_registers):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.unit = unit
+        self.timeout = device_timeout if timeout is None else timeout
+        self.input_registers = input_registers
+        self.holding_registers = holding_registers
+        self.client = None
+
+    async def connect(self):
+        """ Connect to the device, if there is no open connection
+        """
+        if self.client is None or not self.client.connected:
+            log.info('CONNECT TO MODBUS DEVICE %s (%s:%s)...' % (self.name, self.host, self.port))
+            self.client = AsyncioModbusTcpClient(self.host, self.port, loop=asyncio.get_event_loop())
+            await self.client.connect()
+            if not self.client.connected:
+                raise ConnectionError('MODBUS DEVICE %s (%s:%s) IS NOT REACHABLE' % (self.name, self.host, self.port))
+            log.info('CONNECT TO MODBUS DEVICE %s SUCCESSFULLY' % self.name)
+
+    def close(self):
+        """ Close the connection, the next poll reconnects
+        """
+        if self.client is not None:
+            self.client.stop()
+            self.client = None
+
+    async def read(self):
+        """ Read the input and holding register maps of the device
+
+        :return: per register results {register name: {register entry: [value]}}
+        """
+        await self.connect()
+        result = await read_register_map_async(self.client.protocol.read_input_registers, self.input_registers,
+                                               block_read_max_gap, block_read_max_count, self.unit)
+        result.update(await read_register_map_async(self.client.protocol.read_holding_registers,
+                                                    self.holding_registers, block_read_max_gap,
+                                                    block_read_max_count, self.unit))
+        return result
+
+    async def poll(self):
+        """ Read the device within its timeout, a slow or dead device returns None
+
+        :return: per register results or None
+        """
+        try:
+            return await asyncio.wait_for(self.read(), self.timeout)
+        except Exception as e:
+            log.error('POLLING MODBUS DEVICE %s FAILED: %s' % (self.name, repr(e)))
+            self.close()
+            return None
+
+
+async def poll_devices(devices, write_buffer):
+    """ Poll all devices concurrently and write the results as one batch into the database
+
+    :param list devices: list of ModbusDevice
+    :param InfluxDBWriteBuffer write_buffer: store and forward buffer of the database connection
+    """
+    loop = asyncio.get_event_loop()
+    scheduler = FixedRateScheduler('MODBUS DEVICE POLLING', data_sampling_rate)
+    deadband_filter = DeadbandFilter(register_deadbands, default_deadband, deadband_heartbeat)
+    encoder = LineProtocolEncoder([], {'scriptVersion': version})
+    for device in devices:
+        encoder.add_register_maps([device.input_registers, device.holding_registers], device.name)
+    publisher = SamplePublisher() if publish_samples else None
+    while True:
+        log.info('POLL %s MODBUS DEVICES...' % len(devices))
+        results = await asyncio.gather(*[device.poll() for device in devices])
+        timestamp = time.time_ns()
+        log.info('POLL MODBUS DEVICES SUCCESSFULLY (%s OF %s)' % (sum(result is not None for result in results),
+                                                                 len(devices)))
+        log.info('STARTING TO FORMAT COLLECTED DATA FOR THE DATABASE...')
+        encoder.reset()
+        line_count = 0
+        for device, result in zip(devices, results):
+            if result is not None:
+                if publisher is not None:
+                    publisher.publish(result, timestamp, device.name)
+                if report_by_exception:
+                    result = deadband_filter.filter(result, device.name)
+                line_count += encoder.append(result, timestamp, device.name)
+        log.debug('%s POINTS FORMATED' % line_count)
+        if line_count:
+            log.info('WRITE FORMATED DATA TO THE DATABASE...')
+            # The influxdb client blocks, so it should not stall the polling of the devices
+            await loop.run_in_executor(None, write_buffer.write_lines, encoder.getvalue(), line_count)
+            log.info('WRITING TO THE DATABASE SERVER SUCCESSFULLY')
+        await scheduler.wait_async() # Wait for the next cycle on the fixed rate grid
+
+
+def run_asynchronous_client():
+    """Start the asynchronous modbus polling engine via pymodbus
+    """
+    try:
+        log.info('CONNECTING TO THE DATABASE SERVER...')
+        influxdb_client = database_connection() # Connect to the InfluxDB Server
+        write_buffer = write_buffer_connection(influxdb_client) # Buffer the writes, while the database is down
+        log.info('CONNECTING TO THE DATABASE SERVER SUCCESSFULLY')
+        devices = [ModbusDevice(*device) for device in modbus_devices]
+        asyncio.get_event_loop().run_until_complete(poll_devices(devices, write_buffer))
+    except Exception as e:
+        log.error('MODBUS CLIENT CONNECTION FATAL ERROR: ' + str(e))
+
+
+if __name__ == "__main__":
+    run_asynchronous_client()
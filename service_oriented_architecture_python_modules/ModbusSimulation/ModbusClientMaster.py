@@ -12,9 +12,16 @@ Simple modbus client (pymodbus) for reading server data
 """
 from influxdb import InfluxDBClient
 from pymodbus.client.sync import ModbusTcpClient as ModbusClient
-from datetime import datetime, timezone
+from ModbusReadPlanner import read_register_map
+from ModbusPollScheduler import PollScheduler
+from ModbusDeadbandFilter import DeadbandFilter
+from InfluxDBWriteBuffer import InfluxDBWriteBuffer
+from InfluxDBLineProtocolEncoder import LineProtocolEncoder
 import time
 
+from FixedRateScheduler import LoopStatistics
+from SampleChannel import SamplePublisher
+
 # ----------------------------------------------------------------------- #
 # LOGGING                                                                 #
 # ----------------------------------------------------------------------- #
@@ -31,7 +38,18 @@ version = "1.0.0"
 modbus_server_host, modbus_server_port = "localhost", 502 # Modbus Server adress
 influxdb_server_host, influxdb_server_port = "localhost", 8086 # InfluxDB adress
 write_database_name = "modbus_i_o_db" # Modbus database name
-data_sampling_rate = 10 # Rate when the Modbus Server data should be polled
+data_sampling_rate = 10 # Rate when the Modbus Server data should be polled, if a register has no own interval
+poll_scheduler_tick = 0.1 # Registers due within this seconds share their block reads
+block_read_max_gap = 8 # Unused adresses which may be read to join two registers into one block read
+block_read_max_count = 125 # Maximum registers per block read (protocol limit 125)
+report_by_exception = True # Only write values which moved beyond their deadband or whose heartbeat expired
+deadband_heartbeat = 300 # Seconds after which a value is written, even if it did not move
+default_deadband = (0, None) # (absolute, percent) deadband, None = not used -> write every change
+write_buffer_path = "modbus_write_buffer.sqlite" # Local queue for writes, while the database is not available
+write_buffer_max_bytes = 256 * 1024 * 1024 # Size cap of the local queue, the oldest batches are dropped first
+write_buffer_max_age = 7 * 24 * 3600 # Seconds after which queued batches are dropped
+write_buffer_flush_batch_size = 5000 # Maximum points per database write, while the local queue is drained
+publish_samples = True # Stream every fresh sample through the sample channel to the checker
 
 # ----------------------------------------------------------------------- #
 # MODBUS COILS REGISTER                                                   #
@@ -50,7 +68,7 @@ modbus_input_registers = {
     # ----------------------------------------------------------------------- #
     # NILAN IIT-SERIES COMPACT X MODBUS INPUT REGISTER (30000-30249)          #
     # ----------------------------------------------------------------------- #
-    # (adress, name, scale)
+    # (adress, name, scale, poll interval in seconds (optional, default data_sampling_rate))
     "nilan_input_register": [
         (0, "Outlet temperature", 100),
         (1, "Room temperature", 100),
@@ -61,34 +79,34 @@ modbus_input_registers = {
     # ----------------------------------------------------------------------- #
     # KOERPERFETTWAAGE IIT-SERIES ONE MODBUS INPUT REGISTER (30250-30499)     #
     # ----------------------------------------------------------------------- #
-    # (adress, name, scale)
+    # (adress, name, scale, poll interval in seconds (optional, default data_sampling_rate))
     "koerperfettwaage_input_register": [
-        (250, "Body mass index", 100),
-        (251, "Bodyweight", 100),
-        (252, "Body fat percentage", 100),
-        (253, "Fat-free mass", 100),
-        (254, "Fat-free mass index", 100),
-        (255, "Muscle percentage", 100)
+        (250, "Body mass index", 100, 600),
+        (251, "Bodyweight", 100, 600),
+        (252, "Body fat percentage", 100, 600),
+        (253, "Fat-free mass", 100, 600),
+        (254, "Fat-free mass index", 100, 600),
+        (255, "Muscle percentage", 100, 600)
     ],
     # ----------------------------------------------------------------------- #
     # FITNESSBAND IIT-SERIES RUNNER24 MODBUS INPUT REGISTER (30500-30749)     #
     # ----------------------------------------------------------------------- #
-    # (adress, name, scale)
+    # (adress, name, scale, poll interval in seconds (optional, default data_sampling_rate))
     "fitnessband_input_register": [
-        (500, "Age", 1),
-        (501, "Sex", 1),
-        (600, "Arterial oxygen saturation", 1),
-        (601, "Pulse", 1),
-        (602, "Systolic blood pressure value", 1),
-        (603, "Diastolic blood pressure value", 1),
-        (604, "Blood heat", 100)
+        (500, "Age", 1, 3600),
+        (501, "Sex", 1, 3600),
+        (600, "Arterial oxygen saturation", 1, 1),
+        (601, "Pulse", 1, 0.5),
+        (602, "Systolic blood pressure value", 1, 1),
+        (603, "Diastolic blood pressure value", 1, 1),
+        (604, "Blood heat", 100, 0.5)
     ],
     # ----------------------------------------------------------------------- #
     # CHOLESTERIN FASTCHECKER IIT-SERIES MODBUS INPUT REGISTER (30750-30999)  #
     # ----------------------------------------------------------------------- #
-    # (adress, name, scale)
+    # (adress, name, scale, poll interval in seconds (optional, default data_sampling_rate))
     "cholesterin_fastchecker_input_register": [
-        (750, "Cholesterin", 1)
+        (750, "Cholesterin", 1, 600)
     ]
 }
 
@@ -99,7 +117,7 @@ modbus_holding_registers = {
     # ----------------------------------------------------------------------- #
     # NILAN IIT-SERIES COMPACT X MODBUS HOLDING REGISTER (40001-40249)        #
     # ----------------------------------------------------------------------- #
-    # (adress, name, scale)
+    # (adress, name, scale, poll interval in seconds (optional, default data_sampling_rate))
     "nilan_holding_register": [
         (0, "Fan Speed", 1),
         (100, "Minimum room temperature", 100),
@@ -115,16 +133,47 @@ modbus_holding_registers = {
     ]
 }
 
+# ----------------------------------------------------------------------- #
+# REPORT BY EXCEPTION DEADBANDS                                           #
+# ----------------------------------------------------------------------- #
+register_deadbands = {
+    # register name: {description: (absolute, percent)}, None = not used
+    "nilan_input_register": {
+        "Outlet temperature": (10, None),
+        "Room temperature": (10, None),
+        "CO2 level": (None, 1)
+    },
+    "fitnessband_input_register": {
+        "Pulse": (1, None),
+        "Blood heat": (5, None)
+    }
+}
+
 
 def database_connection():
     """ Connect to the database
     """
-    client = InfluxDBClient(influxdb_server_host, influxdb_server_port) # Connect to DB
+    client = InfluxDBClient(influxdb_server_host, influxdb_server_port, gzip=True) # Connect to DB
     client.create_database(write_database_name) # Create DB, if none exist
     client.switch_database(write_database_name) # Switch to the created DB
     return client
 
 
+def line_protocol_encoder():
+    """ Create the line protocol encoder of the register maps
+    """
+    return LineProtocolEncoder([modbus_input_registers, modbus_holding_registers], {'scriptVersion': version})
+
+
+def write_buffer_connection(influxdb_client):
+    """ Create the store and forward buffer for the database writes
+
+    :param InfluxDBClient influxdb_client: database connection of the polling, the flusher gets an own connection
+    """
+    return InfluxDBWriteBuffer(influxdb_client, database_connection(), write_buffer_path, write_buffer_max_bytes, write_buffer_max_age,
+                               write_buffer_flush_batch_size)
+
+
 def run_synchronous_client():
     """Start the synchronous modbus server via pymodbus
     """
@@ -135,9 +184,16 @@ def run_synchronous_client():
         log.info('CONNECT TO MODBUS SERVER SUCCESSFULLY')
         log.info('CONNECTING TO THE DATABASE SERVER...')
         influxdb_client = database_connection() # Connect to the InfluxDB Server
+        write_buffer = write_buffer_connection(influxdb_client) # Buffer the writes, while the database is down
         log.info('CONNECTING TO THE DATABASE SERVER SUCCESSFULLY')
         result = {}
+        scheduler = PollScheduler({'ir': modbus_input_registers, 'hr': modbus_holding_registers},
+                                  data_sampling_rate, poll_scheduler_tick, LoopStatistics('MODBUS REGISTER POLLING'))
+        deadband_filter = DeadbandFilter(register_deadbands, default_deadband, deadband_heartbeat)
+        encoder = line_protocol_encoder()
+        publisher = SamplePublisher() if publish_samples else None
         while True:
+            due = scheduler.wait_due() # Wait for the next registers to poll
             # log.info('READ WHOLE COIL REGISTER...')
             # read whole coil register
             # result.update = {registers: {register: modbus_client.read_coils(register[0]).registers for register in
@@ -148,38 +204,29 @@ def run_synchronous_client():
             # result.update = {registers: {register: modbus_client.read_discrete_inputs(register[0]).registers for register in
             #                       modbus_discrete_inputs_registers[registers]} for registers in modbus_discrete_inputs_registers}
             # log.info('READ WHOLE DISCRETE INPUTS SUCCESSFULLY')
-            log.info('READ WHOLE INPUT REGISTER...')
-            # read whole input register
-            result = {registers: {register: modbus_client.read_input_registers(register[0]).registers for register in
-                                  modbus_input_registers[registers]} for registers in modbus_input_registers}
-            log.info('READ WHOLE INPUT REGISTER SUCCESSFULLY')
-            log.info('READ WHOLE HOLDING REGISTER...')
-            # read whole holding register
-            result.update(
-                {registers: {register: modbus_client.read_holding_registers(register[0]).registers for register in modbus_holding_registers[registers]} for registers in modbus_holding_registers})
-            log.info('READ WHOLE HOLDING REGISTER SUCCESSFULLY')
-            timestamp = datetime.now(timezone.utc)
+            log.info('READ DUE INPUT REGISTER...')
+            # read due input register
+            result = read_register_map(modbus_client.read_input_registers, due['ir'],
+                                       block_read_max_gap, block_read_max_count)
+            log.info('READ DUE INPUT REGISTER SUCCESSFULLY')
+            log.info('READ DUE HOLDING REGISTER...')
+            # read due holding register
+            result.update(read_register_map(modbus_client.read_holding_registers, due['hr'],
+                                            block_read_max_gap, block_read_max_count))
+            log.info('READ DUE HOLDING REGISTER SUCCESSFULLY')
+            timestamp = time.time_ns()
+            if publisher is not None:
+                # The checker gets every sample before the database, the deadband only saves the database
+                publisher.publish(result, timestamp)
+            if report_by_exception:
+                result = deadband_filter.filter(result)
             log.info('STARTING TO FORMAT COLLECTED DATA FOR THE DATABASE...')
-            formated_data = []
-            for register in result:
-                formated_data += [{
-                    'measurement': register,
-                    'time': timestamp,
-                    'tags': {
-                        'scriptVersion': version,
-                        'register': register_entry_details[0],
-                        'description': register_entry_details[1],
-                    },
-                    'fields': {
-                        'value': result[register][register_entry_details][0],
-                        'valueScaled': result[register][register_entry_details][0] / register_entry_details[2]
-                    }
-                } for register_entry_details in result[register]]
-            log.debug(formated_data)
-            log.info('WRITE FORMATED DATA TO THE DATABASE...')
-            influxdb_client.write_points(formated_data)
-            log.info('WRITING TO THE DATABASE SERVER SUCCESSFULLY')
-            time.sleep(data_sampling_rate)
+            formated_data, line_count = encoder.encode(result, timestamp)
+            log.debug('%s POINTS FORMATED' % line_count)
+            if line_count:
+                log.info('WRITE FORMATED DATA TO THE DATABASE...')
+                write_buffer.write_lines(formated_data, line_count)
+                log.info('WRITING TO THE DATABASE SERVER SUCCESSFULLY')
     except Exception as e:
         log.error('MODBUS CLIENT CONNECTION FATAL ERROR: ' + str(e))
 
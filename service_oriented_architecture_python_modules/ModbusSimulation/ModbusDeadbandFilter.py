@@ -0,0 +1,89 @@
+# !DOCUMENTATION SPHINX STYLE
+
+# -*- PingMyHealth -*-
+# Rik Wachner - 1720651 - PingMyHealth Project 2020 - IIT
+
+"""
+PingMyHealth modbus deadband filter
+----------------------------------------------------------------------------
+
+Report by exception: only register values which moved beyond their deadband
+or whose heartbeat expired are written to the database
+
+"""
+import time
+
+# ----------------------------------------------------------------------- #
+# LOGGING                                                                 #
+# ----------------------------------------------------------------------- #
+import logging
+
+log = logging.getLogger()
+
+
+class DeadbandFilter(object):
+    """ In-memory last value cache with an absolute or percent deadband per register
+    """
+
+    def __init__(self, deadbands, default_deadband=(0, None), heartbeat=300, clock=time.monotonic):
+        """
+        :param dict deadbands: deadbands {register name: {description: (absolute, percent)}}, None = not used
+        :param tuple default_deadband: deadband (absolute, percent) of registers without an own deadband
+        :param float heartbeat: seconds after which a value is written, even if it did not move
+        :param function clock: monotonic clock in seconds
+        """
+        self.deadbands = deadbands
+        self.default_deadband = default_deadband
+        self.heartbeat = heartbeat
+        self.clock = clock
+        self.last_values = {} # {(device, register name, adress): (value, monotonic time of the last write)}
+
+    def deadband(self, register, register_entry):
+        """ Get the deadband of a register entry
+
+        :param string register: register name
+        :param tuple register_entry: register entry (adress, name, scale, ...)
+        :return: deadband (absolute, percent)
+        """
+        return self.deadbands.get(register, {}).get(register_entry[1], self.default_deadband)
+
+    def exceeds(self, register, register_entry, value, last_value):
+        """ Check, if a value moved beyond the deadband of its register
+
+        :param string register: register name
+        :param tuple register_entry: register entry (adress, name, scale, ...)
+        :param int value: new register value
+        :param int last_value: last written register value
+        :return: True, if the value should be written
+        """
+        absolute, percent = self.deadband(register, register_entry)
+        difference = abs(value - last_value)
+        if absolute is not None and difference > absolute:
+            return True
+        if percent is not None and (last_value == 0 and difference > 0 or
+                                    last_value != 0 and difference * 100 / abs(last_value) > percent):
+            return True
+        return False
+
+    def filter(self, result, device=None, now=None):
+        """ Remove all values of a result, which are inside their deadband and whose heartbeat did not expire
+
+        :param dict result: per register results {register name: {register entry: [value]}}
+        :param string device: device name, if the cache is shared between several devices
+        :param float now: monotonic time in seconds, default is the clock
+        :return: per register results with only the values to write
+        """
+        now = self.clock() if now is None else now
+        changed, total = {}, 0
+        for register in result:
+            for register_entry, values in result[register].items():
+                total += 1
+                key = (device, register, register_entry[0])
+                value = values[0]
+                last = self.last_values.get(key)
+                if last is None or now - last[1] >= self.heartbeat or self.exceeds(register, register_entry,
+                                                                                     value, last[0]):
+                    self.last_values[key] = (value, now)
+                    changed.setdefault(register, {})[register_entry] = values
+        log.debug('REPORT BY EXCEPTION: %s OF %s VALUES CHANGED' % (sum(map(len, changed.values())), total))
+        return changed
@@ -0,0 +1,117 @@
+# !DOCUMENTATION SPHINX STYLE
+
+# -*- PingMyHealth -*-
+# Rik Wachner - 1720651 - PingMyHealth Project 2020 - IIT
+
+"""
+PingMyHealth modbus poll scheduler
+----------------------------------------------------------------------------
+
+Priority queue scheduler, which polls every register at its own interval
+and batches all registers due at the same tick into shared block reads
+
+"""
+import heapq
+import time
+
+# ----------------------------------------------------------------------- #
+# LOGGING                                                                 #
+# ----------------------------------------------------------------------- #
+import logging
+
+log = logging.getLogger()
+
+
+def register_interval(register_entry, default_interval):
+    """ Get the poll interval of a register entry
+
+    :param tuple register_entry: register entry (adress, name, scale, poll interval (optional))
+    :param float default_interval: poll interval of register entries without an own interval
+    :return: poll interval in seconds
+    """
+    if len(register_entry) > 3 and register_entry[3] is not None:
+        return register_entry[3]
+    return default_interval
+
+
+class PollScheduler(object):
+    """ Schedule the registers of several register maps by their poll interval
+
+    All registers with the same interval share one entry in the priority queue. Every interval is due on a
+    fixed grid of monotonic deadlines, missed deadlines are skipped instead of polled twice
+    """
+
+    def __init__(self, register_maps, default_interval, tick=0.1, statistics=None, clock=time.monotonic):
+        """
+        :param dict register_maps: register maps by kind, e.g. {'ir': modbus_input_registers, 'hr': ...}
+        :param float default_interval: poll interval of register entries without an own interval
+        :param float tick: registers due within this seconds are polled together
+        :param LoopStatistics statistics: jitter, overrun and busy time statistics of the polling, None = off
+        :param function clock: monotonic clock in seconds
+        """
+        self.register_maps = register_maps
+        self.default_interval = default_interval
+        self.tick = tick
+        self.statistics = statistics
+        self.clock = clock
+        self.tick_start = None
+        intervals = {register_interval(register_entry, default_interval) for register_map in register_maps.values()
+                     for registers in register_map.values() for register_entry in registers}
+        for interval in intervals:
+            if interval <= 0:
+                raise ValueError('%s IS NOT A VALID POLL INTERVAL' % interval)
+        now = clock()
+        self.queue = [(now, interval) for interval in sorted(intervals)]
+        heapq.heapify(self.queue)
+
+    def next_deadline(self):
+        """ Get the deadline of the next due registers
+
+        :return: monotonic deadline in seconds
+        """
+        return self.queue[0][0]
+
+    def pop_due(self, now=None):
+        """ Get all registers, which are due until the next tick, and schedule their next deadline
+
+        :param float now: monotonic time in seconds, default is the clock
+        :return: register maps by kind with only the due registers
+        """
+        now = self.clock() if now is None else now
+        due_intervals = set()
+        while self.queue and self.queue[0][0] <= now + self.tick:
+            deadline, interval = heapq.heappop(self.queue)
+            due_intervals.add(interval)
+            deadline += interval
+            if deadline <= now:
+                # Skip the missed deadlines and stay on the grid
+                skipped_ticks = int((now - deadline) // interval) + 1
+                deadline += skipped_ticks * interval
+                if self.statistics is not None:
+                    self.statistics.overrun(skipped_ticks)
+            heapq.heappush(self.queue, (deadline, interval))
+        due = {}
+        for kind, register_map in self.register_maps.items():
+            due[kind] = {}
+            for register, registers in register_map.items():
+                due_registers = [register_entry for register_entry in registers
+                                 if register_interval(register_entry, self.default_interval) in due_intervals]
+                if due_registers:
+                    due[kind][register] = due_registers
+        return due
+
+    def wait_due(self):
+        """ Wait until registers are due and get them
+
+        :return: register maps by kind with only the due registers
+        """
+        deadline = self.next_deadline()
+        now = self.clock()
+        busy_time = 0.0 if self.tick_start is None else now - self.tick_start
+        if deadline > now:
+            time.sleep(deadline - now)
+        last_tick_start = self.tick_start
+        self.tick_start = self.clock()
+        if self.statistics is not None and last_tick_start is not None:
+            self.statistics.record(self.tick_start - deadline, busy_time, self.tick_start - last_tick_start)
+        return self.pop_due(self.tick_start)
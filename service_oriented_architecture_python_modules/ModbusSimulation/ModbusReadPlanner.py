@@ -0,0 +1,111 @@
+# !DOCUMENTATION SPHINX STYLE
+
+# -*- PingMyHealth -*-
+# Rik Wachner - 1720651 - PingMyHealth Project 2020 - IIT
+
+"""
+PingMyHealth modbus read planner
+----------------------------------------------------------------------------
+
+Groups the register maps of the modbus client into the fewest block reads
+and unpacks the returned blocks back into the per register results
+
+"""
+
+# ----------------------------------------------------------------------- #
+# LOGGING                                                                 #
+# ----------------------------------------------------------------------- #
+import logging
+
+log = logging.getLogger()
+
+# ----------------------------------------------------------------------- #
+# PARAMS                                                                  #
+# ----------------------------------------------------------------------- #
+modbus_max_read_count = 125 # Protocol limit of registers per read request
+
+
+def plan_block_reads(register_map, max_gap=0, max_count=modbus_max_read_count):
+    """ Group a register map into the fewest block reads
+
+    Two registers share a block, if the unused addresses between them are not more than max_gap and the
+    whole block does not exceed max_count registers
+
+    :param dict register_map: register map {register name: [(adress, name, scale), ...]}
+    :param int max_gap: count of unused adresses, which may be read to join two blocks
+    :param int max_count: maximum count of registers per block read
+    :return: list of blocks [(start adress, count, [(register name, register entry), ...]), ...]
+    """
+    if max_count < 1 or max_count > modbus_max_read_count:
+        raise ValueError('%s IS NOT A VALID BLOCK READ COUNT (1-%s)' % (max_count, modbus_max_read_count))
+    entries = sorted(((register_entry[0], register, register_entry) for register in register_map
+                      for register_entry in register_map[register]), key=lambda entry: entry[0])
+    blocks = []
+    for address, register, register_entry in entries:
+        if blocks:
+            start, count, members = blocks[-1]
+            # Join the last block, if the gap is tolerable and the protocol limit is not exceeded
+            if address - (start + count) <= max_gap and address - start < max_count:
+                blocks[-1] = (start, max(count, address - start + 1), members + [(register, register_entry)])
+                continue
+        blocks.append((address, 1, [(register, register_entry)]))
+    return blocks
+
+
+def unpack_block_reads(register_map, blocks, block_values):
+    """ Unpack the returned blocks into the per register results
+
+    :param dict register_map: register map {register name: [(adress, name, scale), ...]}
+    :param list blocks: planned blocks of plan_block_reads
+    :param list block_values: register values of each block read, in the order of the blocks
+    :return: per register results {register name: {register entry: [value]}}
+    """
+    # Keep the order of the register map, so the result looks like one read per register
+    result = {register: {register_entry: None for register_entry in register_map[register]}
+              for register in register_map}
+    for (start, count, members), values in zip(blocks, block_values):
+        if len(values) < count:
+            raise ValueError('BLOCK READ AT %s RETURNED %s OF %s REGISTERS' % (start, len(values), count))
+        for register, register_entry in members:
+            result[register][register_entry] = [values[register_entry[0] - start]]
+    return result
+
+
+def read_register_map(read_function, register_map, max_gap=0, max_count=modbus_max_read_count):
+    """ Read a whole register map with block reads
+
+    :param function read_function: pymodbus read function, e.g. modbus_client.read_input_registers
+    :param dict register_map: register map {register name: [(adress, name, scale), ...]}
+    :param int max_gap: count of unused adresses, which may be read to join two blocks
+    :param int max_count: maximum count of registers per block read
+    :return: per register results {register name: {register entry: [value]}}
+    """
+    blocks = plan_block_reads(register_map, max_gap, max_count)
+    log.debug('%s REGISTERS IN %s BLOCK READS' % (sum(len(block[2]) for block in blocks), len(blocks)))
+    block_values = []
+    for start, count, members in blocks:
+        response = read_function(start, count=count)
+        if response.isError():
+            raise ValueError('BLOCK READ AT %s WITH COUNT %s FAILED: %s' % (start, count, response))
+        block_values.append(response.registers)
+    return unpack_block_reads(register_map, blocks, block_values)
+
+
+async def read_register_map_async(read_function, register_map, max_gap=0, max_count=modbus_max_read_count, unit=0):
+    """ Read a whole register map with block reads of an asyncio modbus client
+
+    :param function read_function: pymodbus asyncio read function, e.g. client.protocol.read_input_registers
+    :param dict register_map: register map {register name: [(adress, name, scale), ...]}
+    :param int max_gap: count of unused adresses, which may be read to join two blocks
+    :param int max_count: maximum count of registers per block read
+    :param int unit: modbus unit id of the device
+    :return: per register results {register name: {register entry: [value]}}
+    """
+    blocks = plan_block_reads(register_map, max_gap, max_count)
+    block_values = []
+    for start, count, members in blocks:
+        response = await read_function(start, count=count, unit=unit)
+        if response.isError():
+            raise ValueError('BLOCK READ AT %s WITH COUNT %s FAILED: %s' % (start, count, response))
+        block_values.append(response.registers)
+    return unpack_block_reads(register_map, blocks, block_values)
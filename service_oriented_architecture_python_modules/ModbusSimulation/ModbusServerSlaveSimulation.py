@@ -12,12 +12,16 @@ updating the context while the server is operating
 
 """
 
-from pymodbus.server.asynchronous import StartTcpServer
+from pymodbus.server.asynchronous import ModbusServerFactory, ModbusTcpProtocol
 # from pymodbus.device import ModbusDeviceIdentification
 from pymodbus.datastore import ModbusSequentialDataBlock
 from pymodbus.datastore import ModbusSlaveContext, ModbusServerContext
+from ModbusSparseDataBlock import ArraySegmentDataBlock, build_segments, update_cycle
+from ModbusTraceReplay import TraceReplay
+from twisted.internet import reactor
 from twisted.internet.task import LoopingCall
-import random
+from time import perf_counter
+import numpy as np
 
 # ----------------------------------------------------------------------- #
 # LOGGING                                                                 #
@@ -34,6 +38,16 @@ log.setLevel(logging.DEBUG)
 # version = "1.0.0"
 modbus_server_host, modbus_server_port = "localhost", 502
 update_rate = 10 # Data simulation update rate
+simulation_mode = "random" # "random" fluctuations or "replay" of recorded register traces
+replay_trace_files = ["modbus_trace.bin"] # Time ordered traces (.csv, .json InfluxDB exports or .bin)
+replay_speedup = 100 # Trace seconds replayed per second
+replay_rate = 0.1 # Seconds between two replay steps
+replay_loop = True # Start the replay again, when the traces are at their end
+simulated_units = 1 # Count of simulated slaves (unit ids 1-N), 1 = single slave answering every unit id
+simulated_ports = 1 # Count of listening ports from modbus_server_port on, the slaves are spread over the ports
+statistics_report_rate = 10 # Seconds between two reports of the server request and response rates
+sparse_datastore = True # Only allocate the datastore around the configured registers (memory per slave)
+sparse_datastore_padding = 16 # Free adresses around the configured registers, more than the client block read gap
 
 # ----------------------------------------------------------------------- #
 # MODBUS REGISTER                                                         #
@@ -96,46 +110,184 @@ modbus_holding_registers = [
 registers = modbus_input_registers + modbus_holding_registers # Merge registers
 
 
+class SimulationRules(object):
+    """ Simulation rules (initial value, fluctuations, threshold) of all registers in numpy arrays
+    """
+
+    def __init__(self, registers):
+        """
+        :param list registers: registers [(register type, adresse, initial value, fluctuations, threshold), ...]
+        """
+        registers = sorted(registers, key=lambda register: (register[0], register[1]))
+        self.register_types = np.array([register[0] for register in registers])
+        self.addresses = np.array([register[1] for register in registers])
+        self.initial_values = np.array([register[2] for register in registers])
+        self.fluctuating = np.array([register[3] is not None for register in registers], dtype=bool)
+        self.fluctuation_min = np.array([register[3][0] if register[3] else 0 for register in registers])
+        self.fluctuation_max = np.array([register[3][1] if register[3] else 0 for register in registers])
+        self.threshold_min = np.array([register[4][0] for register in registers])
+        self.threshold_max = np.array([register[4][1] for register in registers])
+        # Contiguous adress ranges of the same register type (register type, start adresse, slice of the arrays)
+        self.ranges = []
+        start = 0
+        for index in range(1, len(registers) + 1):
+            if index == len(registers) or registers[index][0] != registers[start][0] or \
+                    registers[index][1] != registers[index - 1][1] + 1:
+                self.ranges.append((registers[start][0], registers[start][1], slice(start, index)))
+                start = index
+
+    def initialize(self, slave_context):
+        """ Set all registers of a slave context to their initial value
+
+        :param ModbusSlaveContext slave_context: context of one simulated slave
+        """
+        for register_type, address, index in self.ranges:
+            slave_context.setValues(register_type, address, self.initial_values[index].tolist())
+
+    def update(self, slave_context, random_generator):
+        """ Draw the new fluctuations of all registers at once and reset the values out of their threshold
+
+        :param ModbusSlaveContext slave_context: context of one simulated slave
+        :param numpy.random.Generator random_generator: random generator of the fluctuations
+        """
+        values = np.empty(len(self.addresses), dtype=np.int64)
+        for register_type, address, index in self.ranges:
+            values[index] = slave_context.getValues(register_type, address, index.stop - index.start)
+        # Check, if register value is in default threshold range (min, max)
+        in_threshold = (self.threshold_min <= values) & (values <= self.threshold_max)
+        # New "random" value / fluctuation, if fluctuations are specified for that register value
+        fluctuations = random_generator.integers(self.fluctuation_min, self.fluctuation_max, endpoint=True)
+        # If the value is out of default threshold bounce -> reset it to the default value
+        values = np.where(in_threshold, np.where(self.fluctuating, fluctuations, values), self.initial_values)
+        for register_type, address, index in self.ranges:
+            slave_context.setValues(register_type, address, values[index].tolist())
+
+
+class ServerStatistics(object):
+    """ Request and response rates and latency of the modbus server
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """ Start a new report window
+        """
+        self.window_start = perf_counter()
+        self.requests = 0
+        self.responses = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+
+    def record(self, latency, responded):
+        """ Record one executed request
+
+        :param float latency: seconds from the decoded request to the sent response
+        :param bool responded: True, if a response was sent
+        """
+        self.requests += 1
+        self.responses += responded
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+
+    def report(self):
+        """ Log the rates and latency of the current report window and start a new one
+        """
+        elapsed = perf_counter() - self.window_start
+        log.info('SERVER STATISTICS: %.1f REQUESTS/S, %.1f RESPONSES/S, LATENCY MEAN %.3f MS, MAX %.3f MS' % (
+            self.requests / elapsed, self.responses / elapsed,
+            self.latency_sum / self.requests * 1000 if self.requests else 0.0, self.latency_max * 1000))
+        self.reset()
+
+
+server_statistics = ServerStatistics()
+
+
+class StatisticsModbusTcpProtocol(ModbusTcpProtocol):
+    """ Modbus server protocol, which records the request and response statistics
+    """
+
+    def _execute(self, request):
+        """ Executes the request, sends the result and records the statistics
+
+        :param request: The decoded request message
+        """
+        start = perf_counter()
+        self.responded = False
+        ModbusTcpProtocol._execute(self, request)
+        server_statistics.record(perf_counter() - start, self.responded)
+
+    def _send(self, message):
+        """ Send a response and remember it for the statistics
+
+        :param message: The unencoded modbus response
+        """
+        self.responded = message.should_respond
+        return ModbusTcpProtocol._send(self, message)
+
+
+def build_slave_context():
+    """ Build the datastore of one simulated slave
+    """
+    if sparse_datastore:
+        segments = build_segments([register[1] for register in registers], sparse_datastore_padding)
+        return ModbusSlaveContext(
+            di=ArraySegmentDataBlock(segments),
+            co=ArraySegmentDataBlock(segments),
+            hr=ArraySegmentDataBlock(segments),
+            ir=ArraySegmentDataBlock(segments))
+    return ModbusSlaveContext(
+        di=ModbusSequentialDataBlock(0, [0] * 10000),
+        co=ModbusSequentialDataBlock(0, [0] * 10000),
+        hr=ModbusSequentialDataBlock(0, [0] * 10000),
+        ir=ModbusSequentialDataBlock(0, [0] * 10000))
+
+
 def updating_writer(arguments):
     """ A worker process that runs every so often and
     updates live values of the context, to simulation a
-    fluctuation only for the Proof of Concept. It should
-    be noted that there is a race condition for the update
+    fluctuation only for the Proof of Concept. With the
+    sparse datastore every cycle is published at once, so
+    client reads never see a half updated cycle
 
-    :param arguments: The input arguments to the call
+    :param arguments: The input arguments to the call (slave contexts, simulation rules, random generator)
     """
     log.debug("CHECK RULES AND CHANGE CONTEXT...")
-    context = arguments[0]
-    register_call = (None, None) #
-    for register in registers:
-        # Check, if register value is in default threshold range (min, max)
-        if register[4][0] <= context[0].getValues(register[0], register[1])[0] <= register[4][1]:
-            # Check, if fluctuations specified for that register value
-            if register[3] is not None:
-                log.debug("UPDATING THE CONTEXT...")
-                # New "random" value / fluctuation
-                context[0].setValues(register[0], register[1], [random.randint(register[3][0], register[3][1])])
-                log.debug("UPDATING THE CONTEXT SUCCESSFULLY")
-        else:
-            # If the value is out of default threshold bounce -> reset it to the default value
-            context[0].setValues(register[0], register[1], [register[2]])
+    slave_contexts, simulation_rules, random_generator = arguments
+    # Every slave draws its own fluctuations, so the simulated values are independent
+    with update_cycle(slave_contexts):
+        for slave_context in slave_contexts:
+            simulation_rules.update(slave_context, random_generator)
     log.debug("CHECK RULES AND CHANGE CONTEXT SUCCESSFULLY")
 
 
+def replaying_writer(arguments):
+    """ A worker process that runs every so often and
+    replays the recorded register traces into the context
+
+    :param arguments: The input arguments to the call (slave contexts, trace replay)
+    """
+    slave_contexts, trace_replay = arguments
+    with update_cycle(slave_contexts):
+        log.debug("REPLAYED %s TRACE RECORDS" % trace_replay.replay(slave_contexts))
+
+
 def run_updating_server():
     """Start the asynchronous modbus server via pymodbus
     """
     log.info('SET UP REGISTER...')
-    store = ModbusSlaveContext(
-        di=ModbusSequentialDataBlock(0, [0] * 10000),
-        co=ModbusSequentialDataBlock(0, [0] * 10000),
-        hr=ModbusSequentialDataBlock(0, [0] * 10000),
-        ir=ModbusSequentialDataBlock(0, [0] * 10000))
-    context = ModbusServerContext(slaves=store, single=True)
-    for register in registers:
-        context[0].setValues(register[0], register[1], [register[2]])
-
-    log.info('SET UP REGISTER SUCCESSFULLY')
+    simulation_rules = SimulationRules(registers)
+    slave_contexts = [build_slave_context() for unit in range(simulated_units)]
+    for slave_context in slave_contexts:
+        simulation_rules.initialize(slave_context)
+    if simulated_units == 1 and simulated_ports == 1:
+        contexts = [ModbusServerContext(slaves=slave_contexts[0], single=True)]
+    else:
+        # Spread the unit ids 1-N over the ports, every port gets its own server context
+        contexts = [ModbusServerContext(slaves={unit + 1: slave_contexts[unit]
+                                                for unit in range(port, simulated_units, simulated_ports)},
+                                        single=False) for port in range(simulated_ports)]
+    log.info('SET UP REGISTER SUCCESSFULLY (%s UNITS ON %s PORTS)' % (simulated_units, simulated_ports))
 
     # log.info('INITIALIZE THE SERVER INFORMATION...')
     # identity = ModbusDeviceIdentification()
@@ -149,14 +301,28 @@ def run_updating_server():
 
     log.info('SET UP LOOP CONDITION...')
     log.debug('SECONDS DELAY / UPDATE TIME SET')
-    time = update_rate
-    loop = LoopingCall(f=updating_writer, arguments=(context,))
+    if simulation_mode == "replay":
+        log.info('REPLAY %s WITH SPEED-UP %s' % (replay_trace_files, replay_speedup))
+        time = replay_rate
+        loop = LoopingCall(f=replaying_writer, arguments=(slave_contexts, TraceReplay(
+            replay_trace_files, replay_speedup, replay_loop)))
+    else:
+        time = update_rate
+        loop = LoopingCall(f=updating_writer, arguments=(slave_contexts, simulation_rules,
+                                                         np.random.default_rng()))
     log.debug('INITIALLY DELAY / UPDATE TIME BY TIME SET')
     loop.start(time, now=False)
+    statistics_loop = LoopingCall(f=server_statistics.report)
+    statistics_loop.start(statistics_report_rate, now=False)
     log.info('SET UP LOOP CONDITION SUCCESSFULLY')
     log.info('START SERVER AND UPDATE DATA FOR CLIENT CONNECTION...')
-    # StartTcpServer(context, identity=identity, address=(host, port))
-    StartTcpServer(context, address=(modbus_server_host, modbus_server_port))
+    for port, context in enumerate(contexts):
+        # factory = ModbusServerFactory(context, identity=identity)
+        factory = ModbusServerFactory(context)
+        factory.protocol = StatisticsModbusTcpProtocol
+        log.info('LISTEN ON %s:%s' % (modbus_server_host, modbus_server_port + port))
+        reactor.listenTCP(modbus_server_port + port, factory, interface=modbus_server_host)
+    reactor.run()
 
 
 if __name__ == "__main__":
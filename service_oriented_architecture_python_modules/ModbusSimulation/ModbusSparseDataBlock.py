@@ -0,0 +1,168 @@
+# !DOCUMENTATION SPHINX STYLE
+
+# -*- PingMyHealth -*-
+# Rik Wachner - 1720651 - PingMyHealth Project 2020 - IIT
+
+"""
+PingMyHealth sparse modbus datastore
+----------------------------------------------------------------------------
+
+Memory compact datastore for the simulated slaves, which only allocates
+array('H') segments around the configured register adresses
+
+"""
+from pymodbus.datastore.store import BaseModbusDataBlock
+from array import array
+from bisect import bisect_right
+from contextlib import contextmanager, ExitStack
+import threading
+
+
+def build_segments(addresses, padding=16, zero_mode=False):
+    """ Build the segments around the configured register adresses
+
+    Adresses closer than two paddings share one segment, so block reads over small gaps stay valid
+
+    :param list addresses: configured register adresses (protocol adresses)
+    :param int padding: free adresses before and after every configured adresse range
+    :param bool zero_mode: zero mode of the ModbusSlaveContext, otherwise the datastore adresses are shifted by 1
+    :return: list of segments [(start adresse, count), ...] in datastore adresses
+    """
+    offset = 0 if zero_mode else 1
+    segments = []
+    for address in sorted(set(addresses)):
+        start, end = max(0, address - padding), address + padding + 1
+        if segments and start <= segments[-1][1]:
+            segments[-1][1] = max(segments[-1][1], end)
+        else:
+            segments.append([start, end])
+    return [(start + offset, end - start) for start, end in segments]
+
+
+class ArraySegmentDataBlock(BaseModbusDataBlock):
+    """ Sparse modbus datastore backed by array('H') segments
+
+    Reads and writes behave like ModbusSequentialDataBlock inside the segments. Requests outside of the segments
+    or across two segments are invalid
+
+    The segments are double buffered: an update cycle writes into a copy, which is published at the end of the
+    cycle by swapping the reference. Readers always see a consistent snapshot and never wait for the writer,
+    writes outside of an update cycle copy the changed segment (copy-on-write)
+    """
+
+    def __init__(self, segments, default_value=0):
+        """
+        :param list segments: list of segments [(start adresse, count), ...] in datastore adresses
+        :param int default_value: initial value of all adresses
+        """
+        segments = sorted(segments)
+        for (start, count), (next_start, next_count) in zip(segments, segments[1:]):
+            if start + count > next_start:
+                raise ValueError('SEGMENT AT %s OVERLAPS SEGMENT AT %s' % (start, next_start))
+        self.default_value = default_value
+        self.address = segments[0][0] if segments else 0
+        self.starts = [start for start, count in segments]
+        self.segments = [array('H', [default_value]) * count for start, count in segments] # Published snapshot
+        self.pending = None # Back buffer of the running update cycle
+        self.lock = threading.RLock() # Serializes the writers, readers do not take it
+
+    @property
+    def values(self):
+        """ All values of the datastore {adresse: value}, only for inspection
+        """
+        return {start + offset: value for start, segment in zip(self.starts, self.segments)
+                for offset, value in enumerate(segment)}
+
+    def find_segment(self, segments, address, count=1):
+        """ Find the segment, which contains the whole request
+
+        :param list segments: published snapshot or back buffer
+        :param int address: The starting address
+        :param int count: The number of values
+        :return: index of the segment and offset of the address in the segment or (None, None)
+        """
+        index = bisect_right(self.starts, address) - 1
+        if index < 0 or count < 0:
+            return None, None
+        offset = address - self.starts[index]
+        if offset + count > len(segments[index]):
+            return None, None
+        return index, offset
+
+    @contextmanager
+    def update_cycle(self):
+        """ Collect all writes of the cycle in a back buffer and publish it at once
+        """
+        with self.lock:
+            self.pending = [array('H', segment) for segment in self.segments]
+            try:
+                yield
+                self.segments = self.pending # Publish by swapping the reference
+            finally:
+                self.pending = None
+
+    def reset(self):
+        """ Resets the datastore to the initialized default value
+        """
+        with self.lock:
+            self.segments = [array('H', [self.default_value]) * len(segment) for segment in self.segments]
+
+    def validate(self, address, count=1):
+        """ Checks to see if the request is in range
+
+        :param address: The starting address
+        :param count: The number of values to test for
+        :returns: True if the request in within one segment, False otherwise
+        """
+        return self.find_segment(self.segments, address, count)[0] is not None
+
+    def getValues(self, address, count=1):
+        """ Returns the requested values of the published snapshot
+
+        :param address: The starting address
+        :param count: The number of values to retrieve
+        :returns: The requested values from a:a+c
+        """
+        segments = self.segments # One reference, so the read is consistent, even if a cycle is published now
+        index, offset = self.find_segment(segments, address, count)
+        if index is None:
+            raise ValueError('ADRESSES %s-%s ARE NOT IN THE DATASTORE' % (address, address + count - 1))
+        return segments[index][offset:offset + count].tolist()
+
+    def setValues(self, address, values):
+        """ Sets the requested values of the datastore
+
+        :param address: The starting address
+        :param values: The new values to be set
+        """
+        if not isinstance(values, list):
+            values = [values]
+        with self.lock:
+            if self.pending is not None:
+                segments = self.pending
+            else:
+                segments = list(self.segments)
+            index, offset = self.find_segment(segments, address, len(values))
+            if index is None:
+                raise ValueError('ADRESSES %s-%s ARE NOT IN THE DATASTORE' % (address, address + len(values) - 1))
+            if self.pending is None:
+                segments[index] = array('H', segments[index]) # Copy-on-write of the changed segment
+            segments[index][offset:offset + len(values)] = array('H', values)
+            if self.pending is None:
+                self.segments = segments
+
+
+@contextmanager
+def update_cycle(slave_contexts):
+    """ Publish all writes of an update cycle of the slave contexts at once
+
+    Datastores without double buffer (e.g. ModbusSequentialDataBlock) are written directly
+
+    :param list slave_contexts: contexts of the simulated slaves
+    """
+    with ExitStack() as stack:
+        for slave_context in slave_contexts:
+            for block in slave_context.store.values():
+                if isinstance(block, ArraySegmentDataBlock):
+                    stack.enter_context(block.update_cycle())
+        yield
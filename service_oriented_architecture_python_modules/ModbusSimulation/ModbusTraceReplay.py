@@ -0,0 +1,253 @@
+# !DOCUMENTATION SPHINX STYLE
+
+# -*- PingMyHealth -*-
+# Rik Wachner - 1720651 - PingMyHealth Project 2020 - IIT
+
+"""
+PingMyHealth modbus trace replay
+----------------------------------------------------------------------------
+
+Replay recorded register traces (InfluxDB CSV/JSON exports or a compact
+binary format) into the simulated slaves at a configurable speed-up factor
+
+Every trace file is read lazily and has to be ordered by time, several
+trace files (e.g. one export per measurement) are merged by time
+
+"""
+from datetime import datetime, timezone
+import csv
+import heapq
+import json
+import struct
+import sys
+import time
+
+# ----------------------------------------------------------------------- #
+# LOGGING                                                                 #
+# ----------------------------------------------------------------------- #
+import logging
+
+log = logging.getLogger()
+
+# ----------------------------------------------------------------------- #
+# PARAMS                                                                  #
+# ----------------------------------------------------------------------- #
+binary_trace_magic = b'PMHTRACE1' # Header of the binary trace format
+binary_trace_record = struct.Struct('<qBHH') # time in nanoseconds, register type, adresse, value
+binary_trace_chunk = 4096 # Records per read of a binary trace
+register_range = (0, 65535) # Valid adresses and values of a register, the range of the binary trace format
+register_types = {"_input_register": 4, "_holding_register": 3, "_coils_register": 1,
+                  "_discrete_inputs_register": 2} # Register type by the suffix of the measurement name
+
+
+def parse_time(value):
+    """ Parse a timestamp of an export into nanoseconds
+
+    :param string value: epoch in nanoseconds or RFC3339 timestamp
+    :return: timestamp in nanoseconds
+    """
+    if isinstance(value, int) or value.isdigit():
+        return int(value)
+    value, nanoseconds = value.replace('Z', '+00:00'), 0
+    if '.' in value:
+        # The database exports up to nine fraction digits, more than datetime knows
+        value, fraction = value.split('.', 1)
+        digits = len(fraction) - len(fraction.lstrip('0123456789'))
+        nanoseconds = int((fraction[:digits] + '000000000')[:9])
+        value += fraction[digits:]
+    timestamp = datetime.fromisoformat(value)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return int(timestamp.timestamp()) * 1000000000 + nanoseconds
+
+
+def register_type(measurement):
+    """ Get the register type of a measurement of the modbus client
+
+    :param string measurement: measurement name, e.g. fitnessband_input_register
+    :return: register type (4 = input register, 3 = holding register, ...)
+    """
+    for suffix, fx in register_types.items():
+        if measurement.endswith(suffix):
+            return fx
+    raise ValueError('%s IS NOT A MODBUS REGISTER MEASUREMENT' % measurement)
+
+
+def read_csv_trace(path):
+    """ Read an InfluxDB CSV export (influx -format csv) of the modbus client lazily
+
+    :param string path: file of the export
+    :return: generator of records (time in nanoseconds, register type, adresse, value)
+    """
+    with open(path, newline='') as trace_file:
+        for row in csv.DictReader(trace_file):
+            yield (parse_time(row['time']), register_type(row['name']), int(row['register']),
+                   int(float(row['value'])))
+
+
+def read_json_trace(path):
+    """ Read an InfluxDB JSON export of the modbus client lazily
+
+    Every line is either one response of a chunked query (chunked=true) or one point
+    {"name": ..., "time": ..., "register": ..., "value": ...}
+
+    :param string path: file of the export
+    :return: generator of records (time in nanoseconds, register type, adresse, value)
+    """
+    with open(path) as trace_file:
+        for line in trace_file:
+            if not line.strip():
+                continue
+            document = json.loads(line)
+            if 'results' not in document:
+                yield (parse_time(document['time']), register_type(document['name']), int(document['register']),
+                       int(float(document['value'])))
+                continue
+            for result in document['results']:
+                for series in result.get('series', []):
+                    fx = register_type(series['name'])
+                    columns = series['columns']
+                    tags = series.get('tags', {})
+                    for values in series['values']:
+                        row = dict(tags, **dict(zip(columns, values)))
+                        yield parse_time(row['time']), fx, int(row['register']), int(float(row['value']))
+
+
+def read_binary_trace(path):
+    """ Read a binary trace lazily
+
+    :param string path: file of the binary trace
+    :return: generator of records (time in nanoseconds, register type, adresse, value)
+    """
+    with open(path, 'rb') as trace_file:
+        if trace_file.read(len(binary_trace_magic)) != binary_trace_magic:
+            raise ValueError('%s IS NOT A BINARY TRACE' % path)
+        while True:
+            chunk = trace_file.read(binary_trace_record.size * binary_trace_chunk)
+            if not chunk:
+                break
+            chunk = chunk[:len(chunk) - len(chunk) % binary_trace_record.size]
+            yield from binary_trace_record.iter_unpack(chunk)
+
+
+def checked_records(path, records):
+    """ Skip the records of an export, whose adresse or value does not fit into a register (like the binary trace)
+
+    :param string path: file of the export
+    :param records: records of the export
+    :return: generator of the valid records
+    """
+    low, high = register_range
+    for record in records:
+        timestamp, fx, address, value = record
+        if low <= address <= high and low <= value <= high:
+            yield record
+        else:
+            log.error('TRACE RECORD OF FUNCTION CODE %s ADRESSE %s VALUE %s IN %s SKIPPED: NOT A VALID REGISTER' % (
+                fx, address, value, path))
+
+
+def read_trace(path):
+    """ Read a trace lazily, the format is chosen by the file extension (.csv, .json, .bin)
+
+    :param string path: file of the trace
+    :return: generator of records (time in nanoseconds, register type, adresse, value)
+    """
+    if path.endswith('.csv'):
+        return checked_records(path, read_csv_trace(path))
+    if path.endswith('.json'):
+        return checked_records(path, read_json_trace(path))
+    return read_binary_trace(path)
+
+
+def read_traces(paths):
+    """ Read several time ordered traces lazily merged by time
+
+    :param list paths: files of the traces
+    :return: generator of records (time in nanoseconds, register type, adresse, value)
+    """
+    return heapq.merge(*[read_trace(path) for path in paths])
+
+
+def convert_trace(paths, destination):
+    """ Convert time ordered traces into one compact binary trace
+
+    :param list paths: files of the traces
+    :param string destination: file of the binary trace
+    :return: count of converted records
+    """
+    count = 0
+    with open(destination, 'wb') as trace_file:
+        trace_file.write(binary_trace_magic)
+        for record in read_traces(paths):
+            trace_file.write(binary_trace_record.pack(*record))
+            count += 1
+    return count
+
+
+class TraceReplay(object):
+    """ Replay the records of traces into slave contexts at a speed-up factor
+    """
+
+    def __init__(self, paths, speedup=100, loop=True, clock=time.monotonic):
+        """
+        :param list paths: files of the traces
+        :param float speedup: trace seconds replayed per second
+        :param bool loop: start again, when the traces are at their end
+        :param function clock: monotonic clock in seconds
+        """
+        self.paths = paths
+        self.speedup = speedup
+        self.loop = loop
+        self.clock = clock
+        self.invalid = set() # Registers of the traces, which are not in the datastore {(function code, adresse)}
+        self.start()
+
+    def start(self):
+        """ Start the replay from the beginning of the traces
+        """
+        self.records = read_traces(self.paths)
+        self.pending = next(self.records, None)
+        self.wall_start = None
+        self.trace_start = None
+
+    def replay(self, slave_contexts):
+        """ Set all records up to the current replay time into the slave contexts
+
+        :param list slave_contexts: contexts of the simulated slaves
+        :return: count of replayed records
+        """
+        now = self.clock()
+        if self.pending is None:
+            if not self.loop:
+                return 0
+            log.info('TRACE REPLAY AT THE END, START AGAIN')
+            self.start()
+            if self.pending is None:
+                return 0
+        if self.wall_start is None:
+            self.wall_start, self.trace_start = now, self.pending[0]
+        trace_now = self.trace_start + (now - self.wall_start) * self.speedup * 1000000000
+        count = 0
+        while self.pending is not None and self.pending[0] <= trace_now:
+            timestamp, fx, address, value = self.pending
+            self.pending = next(self.records, None)
+            try:
+                for slave_context in slave_contexts:
+                    slave_context.setValues(fx, address, [value])
+            except (ValueError, KeyError, IndexError, OverflowError) as e:
+                # A record outside the datastore is skipped, so it does not stop the replay of all other records
+                if (fx, address) not in self.invalid:
+                    self.invalid.add((fx, address))
+                    log.error('TRACE RECORD OF FUNCTION CODE %s ADRESSE %s SKIPPED: %s' % (fx, address, e))
+                continue
+            count += 1
+        return count
+
+
+if __name__ == "__main__":
+    # python ModbusTraceReplay.py destination.bin export.csv [export.json ...]
+    logging.basicConfig()
+    log.setLevel(logging.INFO)
+    log.info('CONVERT TRACES...')
+    log.info('CONVERT %s RECORDS SUCCESSFULLY' % convert_trace(sys.argv[2:], sys.argv[1]))
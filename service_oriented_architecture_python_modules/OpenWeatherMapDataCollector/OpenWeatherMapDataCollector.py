@@ -14,7 +14,8 @@ Server use the openweathermap api and store the data in the database
 from datetime import datetime, timezone
 from influxdb import InfluxDBClient
 import requests
-import time
+
+from FixedRateScheduler import FixedRateScheduler
 
 # ----------------------------------------------------------------------- #
 # LOGGING                                                                 #
@@ -68,6 +69,7 @@ def run_measurement():
     log.info('CONNECTING TO THE DATABASE SERVER...')
     client = database_connection()
     log.info('CONNECTING TO THE DATABASE SERVER SUCCESSFULLY')
+    scheduler = FixedRateScheduler('OPENWEATHERMAP MEASUREMENT', data_sampling_rate)
     while True:
         try:
             log.info('STARTING TO COLLECT OPENWEATHERMAP MEASUREMENTS...')
@@ -100,7 +102,7 @@ def run_measurement():
             log.info('WRITE FORMATTED DATA TO THE DATABASE...')
             client.write_points(formated_data)
             log.info('WRITING TO THE DATABASE SERVER SUCCESSFULLY')
-            time.sleep(data_sampling_rate)
+            scheduler.wait() # Wait for the next measurement on the fixed rate grid
         except Exception as e:
             log.error('COLLECTING OPENWEATHERMAP MEASUREMENT DATA FAILED: ' + str(e))
             return
@@ -0,0 +1,193 @@
+# !DOCUMENTATION SPHINX STYLE
+
+# -*- PingMyHealth -*-
+# Rik Wachner - 1720651 - PingMyHealth Project 2020 - IIT
+
+"""
+PingMyHealth health rule engine
+----------------------------------------------------------------------------
+
+Compile the nested rule table of the checker once into numpy arrays, which
+are indexed by (measurement, description). All rules of the same input and
+operator are checked with one vectorised comparison
+
+
+Every rule keeps its state (active or not, commanded register value), so
+the checker can act only on state transitions. A hysteresis keeps a rule
+active until its value moved back beyond the threshold by the hysteresis
+
+Only one rule can own a register: if several rules of the same register
+(device, register, adresse) are active, e.g. complementary rules with a
+hysteresis wider than their gap, the rule of the latest transition owns
+the register and the others are released. A released rule triggers again
+only after its condition was false once or the owner was released, so the
+rules do not take turns
+
+"""
+from collections import namedtuple
+import zlib
+import numpy as np
+
+# ----------------------------------------------------------------------- #
+# LOGGING                                                                 #
+# ----------------------------------------------------------------------- #
+import logging
+
+log = logging.getLogger()
+
+# ----------------------------------------------------------------------- #
+# PARAMS                                                                  #
+# ----------------------------------------------------------------------- #
+rule_operators = {
+    '<': np.less,
+    '<=': np.less_equal,
+    '>': np.greater,
+    '>=': np.greater_equal,
+    '==': np.equal,
+    '!=': np.not_equal
+} # Rule operators, a rule triggers if "threshold operator value" is true
+release_directions = {'<': -1, '<=': -1, '>': 1, '>=': 1, '==': 0, '!=': 0} # Shift of the threshold to release
+register_kinds = {2: 'co', 'co': 'co', 3: 'hr', 'hr': 'hr'} # Register numbers and names of the same register
+
+HealthRule = namedtuple('HealthRule', ['index', 'rule_id', 'measurement', 'description', 'rule_operator',
+                                       'threshold', 'hysteresis', 'change_operator', 'change_operand', 'register',
+                                       'address', 'scale', 'device'])
+
+
+def rule_id(measurement, description, rule):
+    """ Get a stable id of a rule, which does not change, if other rules are added or removed
+
+    :param string measurement: measurement of the rule input
+    :param string description: description of the rule input
+    :param tuple rule: rule of the rule table
+    :return: id of the rule (8 hex digits)
+    """
+    return '%08x' % zlib.crc32(repr((measurement, description, rule)).encode())
+
+
+class HealthRuleEngine(object):
+    """ Check all rules of the rule table against the latest values of their inputs
+
+    The rule table has the format of the checker {measurement: {description: (((operator, threshold,
+    hysteresis (optional)), (change operator, change operand, register, adresse, scale, device (optional))), ...)}}
+    """
+
+    def __init__(self, health_data_check, default_hysteresis=0, default_device=None):
+        """
+        :param dict health_data_check: rule table of the checker
+        :param float default_hysteresis: hysteresis of the rules without an own hysteresis
+        :param string default_device: target device of the rules without an own device
+        """
+        self.rules = []
+        self.rule_indices = {} # {rule id: index}
+        self.inputs = {} # {(measurement, description): [(operator function, thresholds, release thresholds,
+        #                                                  rule indices), ...]}
+        log.info('COMPILE RULES...')
+        for measurement in health_data_check:
+            for description in health_data_check[measurement]:
+                by_operator = {}
+                for rule in health_data_check[measurement][description]:
+                    condition, change = rule
+                    rule_operator, threshold = condition[:2]
+                    hysteresis = condition[2] if len(condition) > 2 else default_hysteresis
+                    change_operator, change_operand, register, address, scale = change[:5]
+                    device = change[5] if len(change) > 5 else None
+                    if rule_operator not in rule_operators:
+                        raise ValueError('%s IS NOT A VALID RULE OPERATOR' % rule_operator)
+                    if hysteresis < 0:
+                        raise ValueError('%s IS NOT A VALID HYSTERESIS' % hysteresis)
+                    health_rule = HealthRule(len(self.rules), rule_id(measurement, description, rule), measurement,
+                                             description, rule_operator, threshold, hysteresis, change_operator,
+                                             change_operand, register, address, scale, device)
+                    if health_rule.rule_id in self.rule_indices:
+                        raise ValueError('%s IS A DUPLICATE RULE OF %s' % (rule, description))
+                    self.rule_indices[health_rule.rule_id] = health_rule.index
+                    self.rules.append(health_rule)
+                    by_operator.setdefault(rule_operator, []).append(health_rule)
+                self.inputs[(measurement, description)] = [
+                    (rule_operators[rule_operator],
+                     np.array([health_rule.threshold for health_rule in health_rules], dtype=np.float64),
+                     np.array([health_rule.threshold + release_directions[rule_operator] * health_rule.hysteresis
+                               for health_rule in health_rules], dtype=np.float64),
+                     np.array([health_rule.index for health_rule in health_rules], dtype=np.intp))
+                    for rule_operator, health_rules in by_operator.items()]
+        targets = {} # {(device, register, adresse): [rule index, ...]}
+        for health_rule in self.rules:
+            targets.setdefault((health_rule.device or default_device,
+                                register_kinds.get(health_rule.register, health_rule.register),
+                                health_rule.address), []).append(health_rule.index)
+        # Rule indices of the registers, which are written by several rules
+        self.shared_targets = [np.array(indices, dtype=np.intp) for indices in targets.values() if len(indices) > 1]
+        self.active = np.zeros(len(self.rules), dtype=bool) # State of every rule
+        self.owners = np.full(len(self.rules), -1, dtype=np.intp) # Owner, which released the rule, -1 = none
+        self.commanded = {} # Register value commanded by the active rules {index: value}
+        log.info('COMPILE %s RULES OF %s INPUTS SUCCESSFULLY' % (len(self.rules), len(self.inputs)))
+
+    def evaluate(self, health_data):
+        """ Check all rules, which have a value of their input, and update their state
+
+        Active rules are checked against their release threshold (threshold shifted by the hysteresis). If several
+        rules of a register are active, the rule of the latest transition (the last rule on a tie) owns the register
+        and the others are released
+
+        :param dict health_data: latest values {(measurement, description): value}
+        :return: boolean arrays over all rules (checked, triggered, changed state)
+        """
+        checked = np.zeros(len(self.rules), dtype=bool)
+        triggered = np.zeros(len(self.rules), dtype=bool)
+        for key, value in health_data.items():
+            for operator_function, thresholds, release_thresholds, indices in self.inputs.get(key, ()):
+                checked[indices] = True
+                triggered[indices] = np.where(self.active[indices], operator_function(release_thresholds, value),
+                                              operator_function(thresholds, value))
+        # A rule released by the owner of its register triggers again after its condition was false or the owner
+        # was released
+        suppressed = np.flatnonzero(self.owners >= 0)
+        owner_active = np.where(checked, triggered, self.active)[self.owners[suppressed]]
+        self.owners[suppressed[(checked[suppressed] & ~triggered[suppressed]) | ~owner_active]] = -1
+        triggered &= self.owners < 0
+        previous = self.active.copy()
+        self.active[checked] = triggered[checked]
+        for indices in self.shared_targets:
+            active = indices[self.active[indices]]
+            if len(active) < 2:
+                continue
+            transitioned = active[~previous[active]]
+            owner = transitioned[-1] if len(transitioned) else active[-1]
+            released = active[active != owner]
+            log.warning('RULE %s OWNS THE REGISTER, RELEASE THE OVERLAPPING RULES %s' % (
+                self.rules[owner].rule_id, ', '.join(self.rules[index].rule_id for index in released.tolist())))
+            self.active[released] = False
+            self.owners[released] = owner
+            triggered[released] = False
+            for index in released.tolist():
+                self.commanded.pop(index, None)
+        changed = checked & (triggered != previous)
+        return checked, triggered, changed
+
+    def release(self, index):
+        """ Set a rule inactive, e.g. if its action failed, so the next trigger is a transition again
+
+        :param int index: index of the rule
+        """
+        self.active[index] = False
+        self.commanded.pop(index, None)
+
+    def restore(self, states):
+        """ Restore the state of the rules, e.g. after a restart
+
+        :param dict states: states by rule id {rule id: (active, commanded register value or None)}
+        :return: count of restored rules
+        """
+        count = 0
+        for rule_id, (active, commanded) in states.items():
+            index = self.rule_indices.get(rule_id)
+            if index is None:
+                continue # The rule was removed from the rule table
+            self.active[index] = bool(active)
+            if active and commanded is not None:
+                self.commanded[index] = commanded
+            else:
+                self.commanded.pop(index, None)
+            count += 1
+        return count
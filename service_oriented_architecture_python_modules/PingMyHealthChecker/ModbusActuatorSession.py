@@ -0,0 +1,192 @@
+# !DOCUMENTATION SPHINX STYLE
+
+# -*- PingMyHealth -*-
+# Rik Wachner - 1720651 - PingMyHealth Project 2020 - IIT
+
+"""
+PingMyHealth modbus actuator session
+----------------------------------------------------------------------------
+
+Long-lived modbus session of the checker to one target device. The writes
+of all rules of a cycle are collected and sent as few contiguous
+write_registers/write_coils calls, values the checker wrote itself are
+read from a cache instead of the device. A value is cached only after the
+device confirmed the write, and only for cache_max_age seconds, so changes
+of others are read again from the device
+
+"""
+from pymodbus.client.sync import ModbusTcpClient as ModbusClient
+from pymodbus.exceptions import ModbusException
+import time
+
+# ----------------------------------------------------------------------- #
+# LOGGING                                                                 #
+# ----------------------------------------------------------------------- #
+import logging
+
+log = logging.getLogger()
+
+# ----------------------------------------------------------------------- #
+# PARAMS                                                                  #
+# ----------------------------------------------------------------------- #
+max_write_count = {'co': 1968, 'hr': 123} # Protocol limits of write_coils and write_registers
+cache_max_age = 60 # Seconds after which a written value is read from the device again, None = never
+
+
+def register_kind(register):
+    """ Get the kind of a writable register
+
+    :param register: register number or name (2 or 'co' = coils, 3 or 'hr' = holding register)
+    :return: 'co' or 'hr'
+    """
+    if register in (2, 'co'):
+        return 'co'
+    if register in (3, 'hr'):
+        return 'hr'
+    raise ValueError('%s IS NOT A VALID REGISTER NUMBER TO WRITE TO' % register)
+
+
+def contiguous_runs(values, max_count):
+    """ Split the values into runs of contiguous adresses
+
+    :param dict values: values by adresse {adresse: value}
+    :param int max_count: maximum values per run
+    :return: list of runs [(start adresse, [value, ...]), ...]
+    """
+    runs = []
+    for address in sorted(values):
+        if runs and runs[-1][0] + len(runs[-1][1]) == address and len(runs[-1][1]) < max_count:
+            runs[-1][1].append(values[address])
+        else:
+            runs.append((address, [values[address]]))
+    return runs
+
+
+class ModbusActuatorSession(object):
+    """ Persistent session to one modbus device, which reconnects automatically
+    """
+
+    def __init__(self, name, host, port, unit=0):
+        """
+        :param string name: device name in the log
+        :param string host: adress of the modbus server
+        :param int port: port of the modbus server
+        :param int unit: unit id of the modbus slave
+        """
+        self.name = name
+        self.unit = unit
+        self.client = ModbusClient(host, port)
+        self.cache = {} # Confirmed values the checker wrote last {(kind, adresse): (value, monotonic write time)}
+        self.pending = {'co': {}, 'hr': {}} # Writes of the current cycle {kind: {adresse: value}}
+
+    def connected(self):
+        """ Connect the session, if it is not connected (e.g. after an error)
+
+        :return: True, if the session is connected
+        """
+        if self.client.is_socket_open():
+            return True
+        log.info('CONNECTING TO THE MODBUS DEVICE %s...' % self.name)
+        # The device may have been changed by others, while the session was down
+        self.cache.clear()
+        if not self.client.connect():
+            log.error('CONNECTING TO THE MODBUS DEVICE %s FAILED' % self.name)
+            return False
+        log.info('CONNECTING TO THE MODBUS DEVICE %s SUCCESSFULLY' % self.name)
+        return True
+
+    def disconnect(self):
+        """ Close the session after an error, the next call reconnects
+        """
+        self.client.close()
+        self.cache.clear()
+
+    def cached(self, kind, address):
+        """ Get the value the checker wrote into a register, writes of the current cycle come first
+
+        :param string kind: 'co' or 'hr'
+        :param int address: adresse of the register
+        :return: written value or None, if there is no unexpired value
+        """
+        if address in self.pending[kind]:
+            return self.pending[kind][address]
+        if (kind, address) not in self.cache:
+            return None
+        value, written = self.cache[(kind, address)]
+        if cache_max_age is not None and time.monotonic() - written > cache_max_age:
+            del self.cache[(kind, address)]
+            return None
+        return value
+
+    def read(self, register, address, cached=True):
+        """ Read the current value of a register, written values of the checker come from the cache
+
+        :param register: register number or name (2 or 'co' = coils, 3 or 'hr' = holding register)
+        :param int address: adresse of the register
+        :param bool cached: False = always read the live value of the device
+        :return: value of the register or None, if the device is not available
+        """
+        kind = register_kind(register)
+        if cached:
+            value = self.cached(kind, address)
+            if value is not None:
+                return value
+        if not self.connected():
+            return None
+        try:
+            if kind == 'co':
+                response = self.client.read_coils(address, 1, unit=self.unit)
+            else:
+                response = self.client.read_holding_registers(address, 1, unit=self.unit)
+            if response.isError():
+                raise ModbusException(str(response))
+        except ModbusException as e:
+            log.error('READ FROM THE MODBUS DEVICE %s FAILED: %s' % (self.name, e))
+            self.disconnect()
+            return None
+        return response.bits[0] if kind == 'co' else response.registers[0]
+
+    def write(self, register, address, value):
+        """ Collect a write of the current cycle, later writes to the same adresse replace earlier ones
+
+        :param register: register number or name (2 or 'co' = coils, 3 or 'hr' = holding register)
+        :param int address: adresse of the register
+        :param value: new value of the register
+        """
+        kind = register_kind(register)
+        self.pending[kind][address] = value
+
+    def flush(self):
+        """ Send the collected writes of the cycle as contiguous write calls, the confirmed writes are cached
+
+        :return: confirmed writes {(kind, adresse), ...}, the other writes of the cycle failed
+        """
+        confirmed = set()
+        pending, self.pending = self.pending, {'co': {}, 'hr': {}}
+        if not any(pending.values()):
+            return confirmed
+        if not self.connected():
+            self.cache.clear()
+            return confirmed
+        try:
+            for kind, values in pending.items():
+                for address, run in contiguous_runs(values, max_write_count[kind]):
+                    if kind == 'co':
+                        response = self.client.write_coils(address, run, unit=self.unit)
+                    else:
+                        response = self.client.write_registers(address, run, unit=self.unit)
+                    if response.isError():
+                        raise ModbusException(str(response))
+                    written = time.monotonic()
+                    for offset, value in enumerate(run):
+                        self.cache[(kind, address + offset)] = (value, written)
+                        confirmed.add((kind, address + offset))
+        except ModbusException as e:
+            log.error('WRITE INTO THE MODBUS DEVICE %s FAILED: %s' % (self.name, e))
+            self.disconnect()
+        return confirmed
+
+    def close(self):
+        """ Close the session
+        """
+        self.client.close()
@@ -12,10 +12,20 @@ Simple checker to proof the integration of an monitoring service
 """
 
 from influxdb import InfluxDBClient
-from pymodbus.client.sync import ModbusTcpClient as ModbusClient
+from influxdb.exceptions import InfluxDBClientError
 from datetime import datetime, timezone
+import numpy as np
+import multiprocessing
+import threading
+import queue
 import time
 
+from FixedRateScheduler import FixedRateScheduler
+from SampleChannel import SampleSubscriber
+from InfluxQL import quote_identifier, quote_string
+from HealthRuleEngine import HealthRuleEngine, register_kinds
+from ModbusActuatorSession import ModbusActuatorSession, register_kind
+
 # ----------------------------------------------------------------------- #
 # LOGGING                                                                 #
 # ----------------------------------------------------------------------- #
@@ -31,20 +41,35 @@ log.setLevel(logging.DEBUG)
 version = "1.0.0"
 influxdb_server_host, influxdb_server_port = "localhost", 8086
 modbus_server_host, modbus_server_port = "localhost", 502
+modbus_devices = {"localhost": (modbus_server_host, modbus_server_port, 0)} # Target devices (host, port, unit)
+default_modbus_device = "localhost" # Target device of the rules without an own device
 write_database_name = "pingmyhealth_overwatch_db"
 read_database_name = "modbus_i_o_db"
 measurement_name = "overwatch"
-only_triggered_rules = True # Only the triggered or all checked rules shoud be stored
-data_sampling_rate = 10
-data_sampling_rate_between_health_data_check = 0.5
+only_triggered_rules = True # Only the rules, which changed state or register, or all checked rules shoud be stored
+edge_triggered = True # Change the register only, when a rule becomes active, not in every cycle while it is active
+verify_commanded_values = True # Set the commanded value again, if the live register of an active rule diverged
+default_hysteresis = 0 # Distance beyond the threshold, before an active rule is released (rules can set their own)
+restore_rule_state = True # Restore the state of the rules from the overwatch measurement after a restart
+checker_shards = 1 # Processes, which check the rules in parallel, 1 = no shards
+checker_shard_by = "device" # Partition the rules of the shards by "device" or "measurement"
+shard_restarts = 3 # Restarts of a dead shard, before the checker stops (the rules of the shard are not checked)
+overwatch_batch_size = 5000 # Monitoring points of all shards per database write
+overwatch_flush_interval = 1 # Seconds after which the monitoring points of the shards are written
+overwatch_retry_delay = 1 # Seconds before the first retry of a failed write, doubled after every failed retry
+overwatch_max_retry_delay = 60 # Upper bound of the retry delay
+overwatch_max_points = 100000 # Monitoring points kept while the database is not available, then the oldest are dropped
+data_sampling_rate = 10 # Rate of the database checks, without samples of the sample channel
+subscribe_samples = True # Check the rules on arrival of the samples of the modbus client (sample channel)
 health_data_field = 'value'
+health_data_device = None # Device of the rule inputs (device tag of the asynchronous client), None = synchronous client
 health_data_check = {
     # Machine
     "fitnessband_input_register": {
         # When this rule trigger:
-        # Measurement: ((operator, operand),
+        # Measurement: ((operator, operand, hysteresis (optional)),
         # ... then do this modbus register call:
-        #              (register, adresse), (operator, operand, register, adresse, scale))
+        #              (register, adresse), (operator, operand, register, adresse, scale, device (optional)))
         "Blood heat": ((('<', 3700), ("=", 2442, 3, 102, 100)),
                        (('>', 3700), ("=", 2032, 3, 102, 100)),
                        )
@@ -80,6 +105,401 @@ def database_connection():
     return client
 
 
+def health_data_query(health_data_check):
+    """ Build one query for the latest value of every (measurement, description) of the rules
+
+    The database filters the descriptions and selects the latest value, so the query cost does not grow with the
+    series of the measurements
+
+    :param dict health_data_check: rules {measurement: {description: rules}}
+    :return: InfluxQL query
+    """
+    measurements = ','.join(quote_identifier(measurement) for measurement in sorted(health_data_check))
+    descriptions = sorted({description for measurement in health_data_check
+                           for description in health_data_check[measurement]})
+    where = ' OR '.join('"description" = %s' % quote_string(description) for description in descriptions)
+    # Only the values of the input device, an empty device matches the values of the synchronous client without tag
+    return 'SELECT LAST(%s) AS %s FROM %s WHERE (%s) AND "device" = %s GROUP BY "description"' % (
+        quote_identifier(health_data_field), quote_identifier(health_data_field), measurements, where,
+        quote_string(health_data_device or ''))
+
+
+def fetch_health_data(influxdb_client, query):
+    """ Fetch the latest value of every (measurement, description) of the rules
+
+    :param InfluxDBClient influxdb_client: client of the database server
+    :param string query: query of health_data_query()
+    :return: latest values {(measurement, description): value}
+    """
+    health_data = {}
+    for (measurement, tags), points in influxdb_client.query(query, database=read_database_name).items():
+        for point in points:
+            health_data[(measurement, tags['description'])] = point[health_data_field]
+    return health_data
+
+
+def modbus_sessions(rule_engine):
+    """ Open one persistent session per target device of the rules
+
+    :param HealthRuleEngine rule_engine: compiled rules
+    :return: sessions by device name {device: ModbusActuatorSession}
+    """
+    sessions = {}
+    for rule in rule_engine.rules:
+        device = rule.device or default_modbus_device
+        if device not in modbus_devices:
+            raise ValueError('%s IS NOT A VALID MODBUS DEVICE' % device)
+        if device not in sessions:
+            sessions[device] = ModbusActuatorSession(device, *modbus_devices[device])
+    return sessions
+
+
+def load_rule_state(influxdb_client, rule_engine):
+    """ Restore the state of the rules from their latest overwatch points, e.g. after a restart
+
+    :param InfluxDBClient influxdb_client: client of the database server
+    :param HealthRuleEngine rule_engine: compiled rules
+    :return: count of restored rules
+    """
+    query = 'SELECT "ruleTriggered", "newRegisterValue" FROM %s GROUP BY "ruleId" ORDER BY time DESC LIMIT 1' % (
+        quote_identifier(measurement_name))
+    states = {}
+    for (measurement, tags), points in influxdb_client.query(query, database=write_database_name).items():
+        for point in points:
+            states[tags['ruleId']] = (point['ruleTriggered'], point['newRegisterValue'])
+    return rule_engine.restore(states)
+
+
+def check_rules(rule_engine, health_data, sessions):
+    """ Check the rules of the values and change the modbus registers of the triggered rules
+
+    With edge triggered rules, the register is only changed, when the rule becomes active, or set again to the
+    commanded value, when the live register diverged from it while the rule is active. The monitoring data and the
+    commanded values are built after the writes of the cycle were sent, only confirmed writes count as changed
+    registers. A rule, whose write failed, is released and acts again with the next value
+
+    :param HealthRuleEngine rule_engine: compiled rules
+    :param dict health_data: latest values {(measurement, description): value}, only their rules are checked
+    :param dict sessions: sessions of the target devices {device: ModbusActuatorSession}
+    :return: monitoring data of the checked rules for the database
+    """
+    log.info('CHECK RULES...')
+    # Rules without a value are not checked
+    checked, triggered, changed = rule_engine.evaluate(health_data)
+    log.info('CHECK %s RULES SUCCESSFULLY, %s TRIGGERED, %s CHANGED' % (checked.sum(), triggered.sum(),
+                                                                        changed.sum()))
+    if not edge_triggered:
+        changed = triggered # Every triggered rule acts in every cycle
+    actions = [] # Checked rules of the cycle [(index, old value, new value or None), ...]
+    for index in np.flatnonzero(checked if not only_triggered_rules else changed | triggered).tolist():
+        rule = rule_engine.rules[index]
+        database_value = health_data[(rule.measurement, rule.description)]
+        rule_bool = bool(triggered[index])
+        log.debug('%s %s %s = %s' % (rule.threshold, rule.rule_operator, database_value, rule_bool))
+        old_value, new_value = None, None
+        session = sessions[rule.device or default_modbus_device]
+        if changed[index] and rule_bool:
+            log.info('SELECT MODBUS REGISTER...')
+            # get the old value, the device is only read, if the checker did not write the register itself
+            old_value = session.read(rule.register, rule.address)
+            if old_value is None:
+                rule_engine.release(index) # The device is not available, try again with the next value
+            else:
+                # the rule triggered, send the event with the writes of all other rules of the cycle
+                new_value = operator_lookup_table[rule.change_operator](old_value, rule.change_operand)
+                session.write(rule.register, rule.address, new_value)
+        elif rule_bool and verify_commanded_values and index in rule_engine.commanded:
+            # the rule is still active, only set the commanded value again, if the live register diverged
+            old_value = session.read(rule.register, rule.address, cached=False)
+            if old_value is not None and old_value != rule_engine.commanded[index]:
+                log.warning('REGISTER %s OF RULE %s DIVERGED FROM THE COMMANDED VALUE' % (rule.address,
+                                                                                        rule.rule_id))
+                new_value = rule_engine.commanded[index]
+                session.write(rule.register, rule.address, new_value)
+        elif not rule_bool:
+            rule_engine.commanded.pop(index, None)
+        actions.append((index, old_value, new_value))
+    log.info('WRITE INTO MODBUS REGISTER...')
+    confirmed = {device: session.flush() for device, session in sessions.items()}
+    log.info('WRITE INTO MODBUS REGISTER SUCCESSFULLY (%s CONFIRMED WRITES)' % sum(map(len, confirmed.values())))
+    # In the params list you can desiced, if only the acting or all checked rules shoud be stored
+    monitoring_data = []
+    timestamp = datetime.now(timezone.utc)
+    for index, old_value, new_value in actions:
+        rule = rule_engine.rules[index]
+        if new_value is not None:
+            if (register_kind(rule.register), rule.address) not in confirmed[rule.device or default_modbus_device]:
+                log.error('WRITE OF RULE %s INTO REGISTER %s FAILED' % (rule.rule_id, rule.address))
+                if changed[index]:
+                    rule_engine.release(index) # The device did not get the value, try again with the next value
+                new_value = None # A diverged register keeps its commanded value and is set again next cycle
+            elif changed[index]:
+                rule_engine.commanded[index] = new_value
+        if only_triggered_rules and not changed[index] and new_value is None:
+            continue # Nothing happened, nothing to store
+        log.info('FORMAT MONITORING DATA FOR THE DATABASE...')
+        monitoring_data.append({
+            'measurement': measurement_name,
+            'time': timestamp,
+            'tags': {
+                'scriptVersion': version,
+                'ruleId': rule.rule_id # All rules of a cycle share the timestamp, the tag keeps the points apart
+            },
+            'fields': {
+                'checkValueRegister': rule.measurement,
+                'checkValueDescription': rule.description,
+                'threshold': rule.threshold,
+                'ruleOperator': rule.rule_operator,
+                'databaseValue': health_data[(rule.measurement, rule.description)],
+                'ruleTriggered': bool(rule_engine.active[index]), # State after a release, restored after a restart
+                'changeRegister': rule.register,
+                'changeAddress': rule.address,
+                'oldRegisterValue': old_value,
+                'changeOperator': rule.change_operator,
+                'changeOperand': rule.change_operand,
+                'newRegisterValue': new_value,
+                'newRegisterValueScaled': None if new_value is None else new_value / rule.scale
+            }
+        })
+        log.info('FORMAT RESULT DATA FOR THE DATABASE SUCCESSFULLY')
+    return monitoring_data
+
+
+def write_monitoring_data(influxdb_client, monitoring_data):
+    """ Write the monitoring data of the checked rules into the database
+
+    :param InfluxDBClient influxdb_client: client of the database server
+    :param list monitoring_data: monitoring data of check_rules()
+    """
+    if monitoring_data:
+        log.debug(monitoring_data)
+        log.info('WRITE FORMATED DATA TO THE DATABASE...')
+        influxdb_client.write_points(monitoring_data, database=write_database_name)
+        log.info('WRITING TO THE DATABASE SERVER SUCCESSFULLY')
+
+
+def health_data_source(influxdb_client, query):
+    """ Get the values of every check, either on arrival of the samples or from the database
+
+    :param InfluxDBClient influxdb_client: client of the database server
+    :param string query: query of health_data_query()
+    :return: generator of the latest values {(measurement, description): value}
+    """
+    subscriber = SampleSubscriber(device=health_data_device) if subscribe_samples else None
+    scheduler = FixedRateScheduler('PINGMYHEALTH CHECKER', data_sampling_rate)
+    while True:
+        if subscriber is not None:
+            # Check the rules of every fresh sample on arrival
+            health_data = subscriber.receive(data_sampling_rate)
+            if health_data:
+                log.info('RECEIVED %s SAMPLES' % len(health_data))
+                yield health_data
+                continue
+            log.warning('NO SAMPLES RECEIVED, READ THE DATABASE INSTEAD')
+        log.info('READ DATABASE DATA...')
+        health_data = fetch_health_data(influxdb_client, query)
+        log.info('READ DATABASE DATA SUCCESSFULLY')
+        yield health_data
+        if subscriber is None:
+            scheduler.wait() # Wait for the next check on the fixed rate grid
+
+
+def partition_rules(health_data_check, shards):
+    """ Partition the rule table into shards with about the same count of rules
+
+    The rules are partitioned by checker_shard_by, the rules of one measurement or device stay in one shard. The
+    rules of the same register (device, register, adresse) always stay in one shard, so one rule engine decides,
+    which rule owns the register
+
+    :param dict health_data_check: rule table of the checker
+    :param int shards: count of shards
+    :return: rule tables of the shards [{measurement: {description: rules}}, ...]
+    """
+    groups = {}
+    merged = {} # Group, into which a group was merged {group: group}
+    targets = {} # First group of every register {(device, register, adresse): group}
+
+    def merged_group(group):
+        while merged.get(group, group) != group:
+            group = merged[group]
+        return group
+
+    for measurement in health_data_check:
+        for description in health_data_check[measurement]:
+            for rule in health_data_check[measurement][description]:
+                device = rule[1][5] if len(rule[1]) > 5 and rule[1][5] else default_modbus_device
+                if checker_shard_by == "measurement":
+                    group = measurement
+                elif checker_shard_by == "device":
+                    group = device
+                else:
+                    raise ValueError('%s IS NOT A VALID SHARD KEY' % checker_shard_by)
+                groups.setdefault(group, []).append((measurement, description, rule))
+                target = (device, register_kinds.get(rule[1][2], rule[1][2]), rule[1][3])
+                owner, group = merged_group(targets.setdefault(target, group)), merged_group(group)
+                if owner != group:
+                    merged[group] = owner
+    for group in list(groups):
+        if merged_group(group) != group:
+            groups[merged_group(group)] += groups.pop(group)
+    rule_tables = [{} for shard in range(shards)]
+    rule_counts = [0] * shards
+    # The biggest groups first into the smallest shard
+    for group in sorted(groups, key=lambda group: (-len(groups[group]), str(group))):
+        shard = rule_counts.index(min(rule_counts))
+        rule_counts[shard] += len(groups[group])
+        for measurement, description, rule in groups[group]:
+            rules = rule_tables[shard].setdefault(measurement, {}).setdefault(description, ())
+            rule_tables[shard][measurement][description] = rules + (rule,)
+    return [rule_table for rule_table in rule_tables if rule_table]
+
+
+def run_shard(shard, rule_table, health_data_queue, monitoring_data_queue):
+    """ Check the rules of one shard with its own connections (worker process of the sharded checker)
+
+    :param int shard: number of the shard
+    :param dict rule_table: rule table of the shard
+    :param multiprocessing.Queue health_data_queue: latest values of the coordinator, None = stop
+    :param multiprocessing.Queue monitoring_data_queue: monitoring data to the coordinator
+    """
+    try:
+        rule_engine = HealthRuleEngine(rule_table, default_hysteresis, default_modbus_device)
+        if restore_rule_state:
+            log.info('RESTORE STATE OF %s RULES OF SHARD %s SUCCESSFULLY' % (
+                load_rule_state(database_connection(), rule_engine), shard))
+        sessions = modbus_sessions(rule_engine) # Own sessions, so the shards do not block each other
+        while True:
+            health_data = health_data_queue.get()
+            # A shard behind the coordinator only checks the latest values
+            while health_data is not None and not health_data_queue.empty():
+                try:
+                    newer_health_data = health_data_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if newer_health_data is None:
+                    health_data = None
+                else:
+                    health_data.update(newer_health_data)
+            if health_data is None:
+                break
+            monitoring_data = check_rules(rule_engine, health_data, sessions)
+            if monitoring_data:
+                monitoring_data_queue.put(monitoring_data)
+    except Exception as e:
+        log.error('SHARD %s FATAL ERROR: %s' % (shard, e))
+
+
+def overwatch_writer(influxdb_client, monitoring_data_queue):
+    """ Merge the monitoring data of all shards into batched database writes (thread of the coordinator)
+
+    A failed write keeps the points and is retried with an exponential backoff, the points of the shards are added
+    meanwhile. Only a batch, which the database rejected (4xx), is dropped, because a retry fails again
+
+    :param InfluxDBClient influxdb_client: client of the database server
+    :param multiprocessing.Queue monitoring_data_queue: monitoring data of the shards
+    """
+    monitoring_data = []
+    retry_delay = None # Delay of the next retry, None = the last write succeeded
+    deadline = time.monotonic() + overwatch_flush_interval
+    while True:
+        try:
+            monitoring_data += monitoring_data_queue.get(timeout=max(0.0, deadline - time.monotonic()))
+        except queue.Empty:
+            pass
+        if len(monitoring_data) > overwatch_max_points:
+            log.error('DROP %s OLDEST MONITORING POINTS' % (len(monitoring_data) - overwatch_max_points))
+            monitoring_data = monitoring_data[-overwatch_max_points:]
+        if time.monotonic() < deadline and (retry_delay is not None or len(monitoring_data) < overwatch_batch_size):
+            continue
+        try:
+            write_monitoring_data(influxdb_client, monitoring_data)
+        except Exception as e:
+            if isinstance(e, InfluxDBClientError) and e.code is not None and 400 <= e.code < 500:
+                log.error('DATABASE REJECTED %s MONITORING POINTS: %s' % (len(monitoring_data), e))
+                monitoring_data = []
+                retry_delay = None
+                deadline = time.monotonic() + overwatch_flush_interval
+                continue
+            retry_delay = min(retry_delay * 2, overwatch_max_retry_delay) if retry_delay else overwatch_retry_delay
+            log.error('WRITE %s MONITORING POINTS FAILED, RETRY IN %s S: %s' % (len(monitoring_data), retry_delay, e))
+            deadline = time.monotonic() + retry_delay
+            continue
+        monitoring_data = []
+        retry_delay = None
+        deadline = time.monotonic() + overwatch_flush_interval
+
+
+def start_shard(shard, rule_table, health_data_queue, monitoring_data_queue):
+    """ Start the process of a shard
+
+    :param int shard: number of the shard
+    :param dict rule_table: rule table of the shard
+    :param multiprocessing.Queue health_data_queue: latest values of the coordinator
+    :param multiprocessing.Queue monitoring_data_queue: monitoring data to the coordinator
+    :return: process of the shard
+    """
+    process = multiprocessing.Process(target=run_shard, args=(shard, rule_table, health_data_queue,
+                                                              monitoring_data_queue), daemon=True)
+    process.start()
+    return process
+
+
+def run_sharded_server():
+    """Start the sharded checker, the coordinator reads the values and the shard processes check the rules
+
+    The coordinator checks the shard processes in every cycle and restarts a dead shard up to shard_restarts times,
+    then the checker stops, so the rules of the shard are never silently unchecked
+    """
+    try:
+        log.info('CONNECTING TO THE DATABASE SERVER...')
+        influxdb_client = database_connection()
+        log.info('CONNECTING TO THE DATABASE SERVER SUCCESSFULLY')
+
+        rule_tables = partition_rules(health_data_check, checker_shards)
+        monitoring_data_queue = multiprocessing.Queue()
+        health_data_queues = []
+        processes = []
+        restarts = [0] * len(rule_tables)
+        inputs = {} # Shards of every rule input {(measurement, description): [shard, ...]}
+        log.info('START %s CHECKER SHARDS...' % len(rule_tables))
+        for shard, rule_table in enumerate(rule_tables):
+            health_data_queue = multiprocessing.Queue()
+            health_data_queues.append(health_data_queue)
+            for measurement in rule_table:
+                for description in rule_table[measurement]:
+                    inputs.setdefault((measurement, description), []).append(shard)
+            processes.append(start_shard(shard, rule_table, health_data_queue, monitoring_data_queue))
+        log.info('START CHECKER SHARDS SUCCESSFULLY')
+        # The writer has its own database client, the coordinator reads with the other one
+        threading.Thread(target=overwatch_writer, args=(database_connection(), monitoring_data_queue),
+                         daemon=True).start()
+
+        query = health_data_query(health_data_check) # The rules are static, so the query is built once
+        log.debug(query)
+        for health_data in health_data_source(influxdb_client, query):
+            for shard, process in enumerate(processes):
+                if process.is_alive():
+                    continue
+                if restarts[shard] >= shard_restarts:
+                    raise RuntimeError('SHARD %s DIED %s TIMES' % (shard, restarts[shard] + 1))
+                restarts[shard] += 1
+                log.error('SHARD %s DIED WITH EXIT CODE %s, RESTART %s OF %s...' % (
+                    shard, process.exitcode, restarts[shard], shard_restarts))
+                processes[shard] = start_shard(shard, rule_tables[shard], health_data_queues[shard],
+                                               monitoring_data_queue)
+            # Every shard gets only the values of its own rules
+            shard_data = [{} for health_data_queue in health_data_queues]
+            for key, value in health_data.items():
+                for shard in inputs.get(key, ()):
+                    shard_data[shard][key] = value
+            for shard, health_data_queue in enumerate(health_data_queues):
+                if shard_data[shard]:
+                    health_data_queue.put(shard_data[shard])
+
+    except Exception as e:
+        log.error('SERVER FATAL ERROR: ' + str(e))
+
+
 def run_server():
     """Start the machine learning environment server
     """
@@ -88,101 +508,26 @@ def run_server():
         influxdb_client = database_connection()
         log.info('CONNECTING TO THE DATABASE SERVER SUCCESSFULLY')
 
+        # The rules are compiled once
+        rule_engine = HealthRuleEngine(health_data_check, default_hysteresis, default_modbus_device)
+        if restore_rule_state:
+            log.info('RESTORE RULE STATE...')
+            log.info('RESTORE STATE OF %s RULES SUCCESSFULLY' % load_rule_state(influxdb_client, rule_engine))
         log.info('CONNECTING TO THE MODBUS SERVER...')
-        modbus_client = ModbusClient("localhost", 502)
+        sessions = modbus_sessions(rule_engine) # One session per device, it reconnects by itself
         log.info('CONNECTING TO THE MODBUS SERVER SUCCESSFULLY')
 
-        while True:
-            log.info('READ DATABASE DATA...')
-            for measurement in health_data_check:
-                for description in health_data_check[measurement]:
-                    influxdb_client.switch_database(read_database_name)
-                    # Default InfluxDB database call
-                    python_generator_iterator = influxdb_client.query(
-                        "SELECT * FROM " + measurement + " GROUP BY * ORDER BY DESC LIMIT 1").get_points(
-                        tags={'description': description})
-                    log.info('READ DATABASE DATA SUCCESSFULLY')
-                    influxdb_client.switch_database(write_database_name) # Change database
-                    log.info('CHECK RULES...')
-                    # You need a for loop, also if the select query only contains one value
-                    for value in python_generator_iterator:
-                        # Check now all rules
-                        for rules in health_data_check[measurement][description]:
-                            rule_operator = rules[0][0]
-                            threshold = rules[0][1]
-                            database_value = value[health_data_field]
-                            change_operator = rules[1][0]
-                            change_operand = rules[1][1]
-                            register = rules[1][2]
-                            address = rules[1][3]
-                            scale = rules[1][4]
-                            old_value, new_value = None, None
-                            # Check, if the rule triggered
-                            rule_bool = operator_lookup_table[rule_operator](threshold, database_value)
-                            log.debug('%s %s %s = %s' % (threshold, rule_operator, database_value, rule_bool))
-                            log.info('CHECK RULE SUCCESSFULLY')
-                            log.info('SELECT MODBUS REGISTER...')
-                            modbus_client.connect()
-                            # get the old values
-                            if register in (2, 'co'):
-                                log.info('SELECT COIL REGISTER (WRITE-ONLY)')
-                                old_value = modbus_client.read_coils(address).registers
-                                # if the rule triggered, send the event
-                                if rule_bool:
-                                    new_value = operator_lookup_table[change_operator](old_value[0], change_operand)
-                                    modbus_client.write_coils(address, [new_value])
-                            # get the old values
-                            elif register in (3, 'hr'):
-                                log.info('SELECT HOLDING REGISTER (READ AND WRITE)')
-                                old_value = modbus_client.read_holding_registers(address).registers
-                                # if the rule triggered, send the event
-                                if rule_bool:
-                                    new_value = operator_lookup_table[change_operator](old_value[0], change_operand)
-                                    modbus_client.write_registers(address, new_value)
-                            else:
-                                raise ValueError('%s IS NOT A VALID REGISTER NUMBER TO WRITE TO' % register)
-
-                            modbus_client.close()
-                            log.info('WRITE INTO MODBUS REGISTER SUCCESSFULLY')
-                            modbus_client.close()
-                            # In the params list you can desiced, if only the triggered or all checked rules shoud be stored 
-                            if only_triggered_rules is False or only_triggered_rules and rule_bool:
-                                log.info('FORMAT MONITORING DATA FOR THE DATABASE...')
-                                timestamp = datetime.now(timezone.utc)
-                                monitoring_data = [{
-                                    'measurement': measurement_name,
-                                    'time': timestamp,
-                                    'tags': {
-                                        'scriptVersion': version,
-                                    },
-                                    'fields': {
-                                        'checkValueRegister': measurement,
-                                        'checkValueDescription': description,
-                                        'threshold': threshold,
-                                        'ruleOperator': rule_operator,
-                                        'databaseValue': database_value,
-                                        'ruleTriggered': rule_bool,
-                                        'changeRegister': register,
-                                        'changeAddress': address,
-                                        'oldRegisterValue': None if old_value is None else old_value[0],
-                                        'changeOperator': change_operator,
-                                        'changeOperand': change_operand,
-                                        'newRegisterValue': new_value,
-                                        'newRegisterValueScaled': None if new_value is None else new_value / scale
-                                    }
-                                }]
-                                log.info('FORMAT RESULT DATA FOR THE DATABASE SUCCESSFULLY')
-                                log.debug(monitoring_data)
-                                log.info('WRITE FORMATED DATA TO THE DATABASE...')
-                                influxdb_client.write_points(monitoring_data)
-                                log.info('WRITING TO THE DATABASE SERVER SUCCESSFULLY')
-                            time.sleep(data_sampling_rate_between_health_data_check)
-
-            time.sleep(data_sampling_rate)
+        query = health_data_query(health_data_check) # The rules are static, so the query is built once
+        log.debug(query)
+        for health_data in health_data_source(influxdb_client, query):
+            write_monitoring_data(influxdb_client, check_rules(rule_engine, health_data, sessions))
 
     except Exception as e:
         log.error('SERVER FATAL ERROR: ' + str(e))
 
 
 if __name__ == "__main__":
-    run_server()
+    if checker_shards > 1:
+        run_sharded_server()
+    else:
+        run_server()
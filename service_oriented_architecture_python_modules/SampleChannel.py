@@ -0,0 +1,142 @@
+# !DOCUMENTATION SPHINX STYLE
+
+# -*- PingMyHealth -*-
+# Rik Wachner - 1720651 - PingMyHealth Project 2020 - IIT
+
+"""
+PingMyHealth sample channel
+----------------------------------------------------------------------------
+
+Local publish/subscribe channel (UDP unicast or multicast), through which
+the modbus clients stream every fresh sample directly to the checker. The
+database stays the archive of the samples, not their transport
+
+Every datagram is one JSON message
+{"time": nanoseconds, "device": name, "samples": [[measurement, description, value], ...]}
+
+"""
+import ipaddress
+import json
+import select
+import socket
+import struct
+
+# ----------------------------------------------------------------------- #
+# LOGGING                                                                 #
+# ----------------------------------------------------------------------- #
+import logging
+
+log = logging.getLogger()
+
+# ----------------------------------------------------------------------- #
+# PARAMS                                                                  #
+# ----------------------------------------------------------------------- #
+sample_channel_host, sample_channel_port = "127.0.0.1", 5021 # Unicast or multicast (e.g. 239.0.0.1) adress
+samples_per_datagram = 100 # Samples per datagram, so a datagram stays below the usual UDP limits
+multicast_ttl = 1 # Multicast datagrams stay in the local network
+
+
+def is_multicast(host):
+    """ Check, if the adress of the channel is a multicast group
+
+    :param string host: adress of the channel
+    :return: True, if the adress is a multicast group
+    """
+    try:
+        return ipaddress.ip_address(host).is_multicast
+    except ValueError:
+        return False
+
+
+class SamplePublisher(object):
+    """ Publish the samples of the modbus clients into the sample channel
+
+    Publishing never blocks and never fails the polling, lost datagrams are only logged
+    """
+
+    def __init__(self, host=sample_channel_host, port=sample_channel_port):
+        """
+        :param string host: unicast or multicast adress of the channel
+        :param int port: port of the channel
+        """
+        self.address = (host, port)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        if is_multicast(host):
+            self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, multicast_ttl)
+
+    def publish(self, result, timestamp, device=None):
+        """ Publish the per register results of one cycle
+
+        :param dict result: per register results {register name: {register entry: [value]}}
+        :param int timestamp: timestamp in nanoseconds
+        :param string device: device name, None = no device
+        :return: count of published samples
+        """
+        samples = [[register, register_entry[1], values[0]] for register in result
+                   for register_entry, values in result[register].items()]
+        for start in range(0, len(samples), samples_per_datagram):
+            message = {'time': timestamp, 'device': device, 'samples': samples[start:start + samples_per_datagram]}
+            try:
+                self.socket.sendto(json.dumps(message).encode(), self.address)
+            except OSError as e:
+                log.warning('PUBLISH SAMPLES FAILED: ' + str(e))
+        return len(samples)
+
+    def close(self):
+        """ Close the channel
+        """
+        self.socket.close()
+
+
+class SampleSubscriber(object):
+    """ Receive the samples of one device of the sample channel
+
+    The samples are keyed by (measurement, description), so the samples of other devices are skipped. Otherwise
+    the samples of the device, which arrived last, would overwrite the samples of all other devices
+    """
+
+    def __init__(self, host=sample_channel_host, port=sample_channel_port, device=None):
+        """
+        :param string host: unicast or multicast adress of the channel
+        :param int port: port of the channel
+        :param string device: device of the samples, None = the samples without device (synchronous modbus client)
+        """
+        self.device = device
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if is_multicast(host):
+            self.socket.bind(('', port))
+            membership = struct.pack('4s4s', socket.inet_aton(host), socket.inet_aton('0.0.0.0'))
+            self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        else:
+            self.socket.bind((host, port))
+        self.socket.setblocking(False)
+
+    def receive(self, timeout=None):
+        """ Wait for samples and get all samples, which arrived in the meantime
+
+        :param float timeout: seconds to wait for the first datagram, None = wait forever
+        :return: latest values of the device {(measurement, description): value}, empty if the timeout expired
+        """
+        samples = {}
+        readable, _, _ = select.select([self.socket], [], [], timeout)
+        while readable:
+            try:
+                datagram = self.socket.recv(65535)
+            except BlockingIOError:
+                break
+            try:
+                message = json.loads(datagram)
+                if message['device'] != self.device:
+                    continue
+                for measurement, description, value in message['samples']:
+                    samples[(measurement, description)] = value
+            except (ValueError, KeyError, TypeError):
+                log.warning('%s IS NOT A VALID SAMPLE MESSAGE' % datagram[:64])
+        return samples
+
+    def close(self):
+        """ Close the channel
+        """
+        self.socket.close()